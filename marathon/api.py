@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import uuid
+import tarfile
+import tempfile
+import logging
+import threading
+import http.client as http
+
+from urllib.parse import urlsplit, quote
+
+from marathon.utils import sanitize_service_name
+from marathon import iam, tokens, warmup
+from marathon.profiler import span, HTTP
+from marathon.scheduler import run_steps
+from marathon import throttle
+import marathon.cached as cached
+
+log = logging.getLogger(__name__)
+
+# Send every request to this endpoint instead (e.g. http://127.0.0.1:8080 for a fake server),
+# the real API host is kept in the Host header
+API_ENDPOINT = os.environ.get("MARATHON_API_ENDPOINT", "")
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+MANIFEST_TYPES = ", ".join([
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+])
+READY_TIMEOUT = 10 * 60
+POLL_INTERVAL = 2
+
+_connections = threading.local()
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+def build(service):
+    if not service.project or not service.dir or not service.image:
+        log.error((f"Failed to build {service.name}: 'project', '{service.name}.dir' and"
+                   f" '{service.name}.image' are required in run.yaml"))
+        return False
+
+    # Returns the digest of the pushed image, or True if the build didn't report it
+    digests = build_services([service])
+    if digests is None:
+        return False
+    return digests.get(service.image) or True
+
+
+def build_services(services):
+    # One Cloud Build for all services, returns {image: digest} of the pushed images or None if it failed
+    from marathon import cloudbuild
+
+    names = ", ".join(service.name for service in services)
+    project = services[0].project
+    root = cloudbuild.source_dir(services)
+    bucket = f"{project}_cloudbuild"
+    source = f"source/{int(time.time())}-{uuid.uuid4().hex}.tgz"
+
+    try:
+        if request("GET", f"https://storage.googleapis.com/storage/v1/b/{bucket}") is None:
+            request("POST", f"https://storage.googleapis.com/storage/v1/b?project={project}",
+                    {"name": bucket})
+        with tar_directory(root) as tarball:
+            request("POST", (f"https://storage.googleapis.com/upload/storage/v1/b/{bucket}/o"
+                             f"?uploadType=media&name={quote(source, safe='')}"),
+                    tarball, content_type="application/gzip")
+
+        operation = request("POST", f"https://cloudbuild.googleapis.com/v1/projects/{project}/builds", {
+            "source": {"storageSource": {"bucket": bucket, "object": source}},
+            **cloudbuild.config(services, root),
+        })
+        build_id = operation["metadata"]["build"]["id"]
+        while True:
+            status = request("GET",
+                             f"https://cloudbuild.googleapis.com/v1/projects/{project}/builds/{build_id}")
+            if status["status"] not in ("QUEUED", "WORKING", "STATUS_UNKNOWN"):
+                break
+            time.sleep(POLL_INTERVAL)
+    except (ApiError, OSError) as e:
+        log.error(f"Failed to build {names}: {e}")
+        return None
+
+    if status["status"] != "SUCCESS":
+        log.error(f"Failed to build {names}: {status['status']} {status.get('logUrl', '')}")
+        return None
+    return cloudbuild.image_digests(status)
+
+
+def tar_directory(dir):
+    # The build source as gcloud uploads it, without what .gcloudignore leaves out, spooled to a temp
+    # file so large sources aren't held in memory
+    from marathon import state
+
+    tarball = tempfile.TemporaryFile()
+    with tarfile.open(fileobj=tarball, mode="w:gz") as tar:
+        for path, full_path in state.source_files(dir, state.upload_ignore_rules(dir)):
+            tar.add(full_path, arcname=path, recursive=False)
+    return tarball
+
+
+def deploy(service, iam_plan, canary=False):
+    if not service.project or not service.region or not service.image:
+        log.error((f"Failed to deploy {service.name}: 'project', 'region' and '{service.name}.image'"
+                   " are required in run.yaml"))
+        return False
+    if canary:
+        log.error(f"Failed to deploy {service.target}: --canary is only supported by the gcloud backend")
+        return False
+
+    project, region = service.project, service.region
+    sanitized_service = service.sanitized_name
+    service_account = {}
+
+    def step(fn):
+        def run():
+            try:
+                # A step returning False has logged why it failed
+                if fn() is False:
+                    return False
+            except (ApiError, iam.IamError) as e:
+                log.error(f"Failed to deploy {service.target}: {e}")
+                return False
+            return True
+        return run
+
+    def service_account_step():
+        service_account["email"] = setup_service_iam(service)
+
+    def deploy_step():
+        log.debug(f"Deploying {service.name} with configuration: {service.raw}")
+        replace_service(service, service_account["email"])
+        cached.service_endpoints.invalidate((sanitized_service, project, region))
+
+    def iam_step():
+        _, policies = iam_plan
+        resource = iam.service_resource(service.name, project, region)
+        role_members = {role: set(members) for role, members in policies.get(resource, {}).items()}
+        public = {iam.INVOKER_ROLE: {"allUsers"}}
+        if not service.authenticated:
+            role_members.setdefault(iam.INVOKER_ROLE, set()).add("allUsers")
+        iam.apply(resource, role_members, get_iam_policy, set_iam_policy,
+                  remove=public if service.authenticated else None)
+
+    def warmup_step():
+        url = get_service_endpoint(sanitized_service, project, region)
+        if url:
+            warmup.run(service, url, tokens.get(tokens.IDENTITY))
+
+    # Steps without a dependency between them run concurrently
+    steps = {
+        "service account": (step(service_account_step), set()),
+        "deploy": (step(deploy_step), {"service account"}),
+        "iam": (step(iam_step), {"deploy"}),
+    }
+    if service.cron and service.primary:
+        steps["cron"] = (step(lambda: setup_cron(service)), {"deploy"})
+    if service.warmup:
+        steps["warmup"] = (step(warmup_step), {"iam"})
+    if not run_steps(steps):
+        return False
+
+    deployed_url = get_service_endpoint(sanitized_service, project, region)
+    if deployed_url:
+        log.info(f"[{service.target}]: {deployed_url}")
+
+    return True
+
+
+def replace_service(service, service_account):
+    project, region = service.project, service.region
+    sanitized_service = service.sanitized_name
+    url = service_url(sanitized_service, project, region)
+    existing = request("GET", url)
+    if existing:
+        body = existing
+        body["metadata"].setdefault("labels", {}).update(service_labels(service))
+        body["spec"] = service_spec(service, service_account)
+        request("PUT", url, body)
+    else:
+        request("POST", url.rsplit("/", 1)[0], {
+            "apiVersion": "serving.knative.dev/v1",
+            "kind": "Service",
+            "metadata": {
+                "name": sanitized_service,
+                "namespace": project,
+                "labels": service_labels(service),
+                "annotations": {"run.googleapis.com/launch-stage": "BETA"},
+            },
+            "spec": service_spec(service, service_account),
+        })
+    wait_ready(sanitized_service, project, region)
+
+
+def wait_ready(service, project, region):
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        body = request("GET", service_url(service, project, region))
+        if body is None:
+            raise ApiError(404, f"{service} was deleted while waiting for it to become ready")
+        status = body.get("status", {})
+        for condition in status.get("conditions", []):
+            if condition["type"] == "Ready" and condition["status"] == "True":
+                return
+            if condition["type"] == "Ready" and condition["status"] == "False":
+                raise ApiError(500, condition.get("message", "service is not ready"))
+        time.sleep(POLL_INTERVAL)
+    raise ApiError(504, f"timed out waiting for {service} to become ready")
+
+
+def deploy_config(service, service_account):
+    return json.dumps({
+        "spec": service_spec(service, service_account),
+        "labels": service_labels(service),
+        "authenticated": str(service.authenticated).lower(),
+    }, sort_keys=True)
+
+
+def service_labels(service):
+    return dict(service.labels)
+
+
+def service_spec(service, service_account):
+    annotations = {}
+    container = {"image": service.image}
+    spec = {"serviceAccountName": service_account, "containers": [container]}
+
+    if service.concurrency:
+        spec["containerConcurrency"] = int(service.concurrency)
+
+    if service.timeout:
+        spec["timeoutSeconds"] = int(service.timeout.rstrip("s"))
+
+    if service.max_instances:
+        annotations["autoscaling.knative.dev/maxScale"] = service.max_instances
+
+    if service.min_instances:
+        annotations["autoscaling.knative.dev/minScale"] = service.min_instances
+
+    if service.cpu_boost is not None:
+        annotations["run.googleapis.com/startup-cpu-boost"] = str(service.cpu_boost).lower()
+
+    limits = {}
+    if service.cpu:
+        limits["cpu"] = service.cpu
+    if service.memory:
+        limits["memory"] = service.memory
+    if limits:
+        container["resources"] = {"limits": limits}
+
+    if service.port:
+        container["ports"] = [{"containerPort": int(service.port)}]
+
+    if service.command:
+        container["command"] = service.command.split(",")
+
+    if service.args:
+        container["args"] = list(service.args)
+
+    if service.vpc_connector:
+        annotations["run.googleapis.com/vpc-access-connector"] = service.vpc_connector
+
+    if service.cloudsql_instances:
+        annotations["run.googleapis.com/cloudsql-instances"] = ",".join(service.cloudsql_instances)
+
+    env = [{"name": key, "value": value} for key, value in service.env.items()]
+    for link in service.links:
+        url = get_service_endpoint(sanitize_service_name(link), service.project, service.link_regions[link])
+        if url:
+            env.append({"name": link.upper().replace("-", "_") + "_URL", "value": url})
+    if env:
+        container["env"] = env
+
+    return {"template": {"metadata": {"annotations": annotations}, "spec": spec}}
+
+
+def setup_service_iam(service):
+    # Roles and invoker bindings are applied in batches by marathon.iam
+    return ensure_service_account(iam.service_account_name(service.name), service.project)
+
+
+def ensure_service_account(name, project):
+    email = iam.service_account_email(name, project)
+    if service_account_exists(email, project):
+        return email
+
+    log.debug(f"Creating service account {name} ...")
+    try:
+        request("POST", f"https://iam.googleapis.com/v1/projects/{project}/serviceAccounts",
+                {"accountId": name})
+    except ApiError as e:
+        if e.status != 409:
+            raise
+    cached.service_accounts.set((email, project), True)
+    return email
+
+
+def service_account_exists(service_account_email, project):
+    return cached.service_accounts.get((service_account_email, project), lambda: request(
+        "GET", f"https://iam.googleapis.com/v1/projects/{project}/serviceAccounts/{service_account_email}"
+    ) is not None)
+
+
+def setup_cron(service):
+    project, region = service.project, service.region
+    sanitized_service = service.sanitized_name
+    cron_config = service.cron
+    if "schedule" not in cron_config:
+        log.error(f"No 'schedule' specified in cron config for {service.name} in run.yaml")
+        return False
+
+    cron_sa_email = ensure_service_account(iam.CRON_SERVICE_ACCOUNT, project)
+
+    service_endpoint = get_service_endpoint(sanitized_service, project, region)
+    if not service_endpoint:
+        log.error(f"Failed to create/update Cloud Scheduler job for {service.name}, no service endpoint")
+        return False
+
+    job = f"{sanitized_service}-job"
+    jobs_url = f"https://cloudscheduler.googleapis.com/v1/projects/{project}/locations/{region}/jobs"
+    body = {
+        "name": f"projects/{project}/locations/{region}/jobs/{job}",
+        "schedule": cron_config["schedule"],
+        "httpTarget": {
+            "uri": f"{service_endpoint}{cron_config.get('path', '/')}",
+            "httpMethod": str(cron_config.get("http-method", "post")).upper(),
+            "oidcToken": {"serviceAccountEmail": cron_sa_email, "audience": service_endpoint},
+        },
+    }
+
+    exists = cached.scheduler_jobs.get((job, project),
+                                       lambda: request("GET", f"{jobs_url}/{job}") is not None)
+    if exists:
+        request("PATCH", f"{jobs_url}/{job}", body)
+    else:
+        log.info(f"Creating Cloud Scheduler job for {service.name} ...")
+        request("POST", jobs_url, body)
+        cached.scheduler_jobs.set((job, project), True)
+
+
+def allow_invoke(service, iam_plan):
+    _, policies = iam_plan
+    resource = iam.service_resource(service.name, service.project, service.region)
+    if resource in policies:
+        iam.apply(resource, policies[resource], get_iam_policy, set_iam_policy)
+
+
+def policy_url(resource):
+    if resource[0] == "project":
+        return f"https://cloudresourcemanager.googleapis.com/v1/projects/{resource[1]}"
+    _, service, project, region = resource
+    return f"https://run.googleapis.com/v1/projects/{project}/locations/{region}/services/{service}"
+
+
+def get_iam_policy(resource):
+    try:
+        if resource[0] == "project":
+            # Version 3 keeps the conditions of conditional bindings, which are written back as they are
+            return request("POST", f"{policy_url(resource)}:getIamPolicy",
+                           {"options": {"requestedPolicyVersion": 3}}) or {}
+        return request("GET", f"{policy_url(resource)}:getIamPolicy") or {}
+    except ApiError as e:
+        raise iam.IamError(str(e))
+
+
+def set_iam_policy(resource, policy):
+    try:
+        if resource[0] == "project":
+            policy = {**policy, "version": 3}
+        request("POST", f"{policy_url(resource)}:setIamPolicy", {"policy": policy})
+    except ApiError as e:
+        # The etag in the policy is stale, someone else updated it since we read it
+        if e.status in (409, 412):
+            raise iam.PolicyConflict(str(e))
+        raise iam.IamError(str(e))
+
+
+def prefetch(project, regions, service_accounts, jobs):
+    # One list call per resource type and region instead of one GET per service
+    try:
+        for region in regions:
+            services = request("GET", service_url("", project, region).rstrip("/")) or {}
+            for item in services.get("items", []):
+                url = item.get("status", {}).get("url")
+                if url:
+                    cached.service_endpoints.set((item["metadata"]["name"], project, region), url)
+
+        existing = set()
+        page_token = ""
+        while True:
+            page = request("GET", (f"https://iam.googleapis.com/v1/projects/{project}/serviceAccounts"
+                                   f"?pageSize=100&pageToken={page_token}")) or {}
+            existing.update(account["email"] for account in page.get("accounts", []))
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                break
+        for email in existing | set(service_accounts):
+            cached.service_accounts.set((email, project), email in existing)
+
+        if jobs:
+            existing = set()
+            for region in regions:
+                page_token = ""
+                while True:
+                    page = request("GET", (f"https://cloudscheduler.googleapis.com/v1/projects/{project}"
+                                           f"/locations/{region}/jobs?pageSize=500&pageToken={page_token}")) or {}
+                    existing.update(job["name"].rsplit("/", 1)[-1] for job in page.get("jobs", []))
+                    page_token = page.get("nextPageToken")
+                    if not page_token:
+                        break
+            for job in existing | set(jobs):
+                cached.scheduler_jobs.set((job, project), job in existing)
+    except (ApiError, KeyError) as e:
+        log.debug(f"Prefetch failed, falling back to per-service lookups: {e}")
+
+
+def get_service_endpoint(service, project, region):
+    def fetch():
+        try:
+            body = request("GET", service_url(service, project, region))
+            return body["status"]["url"] if body else None
+        except (ApiError, KeyError) as e:
+            log.debug(e)
+            log.info(f"Failed to get service endpoint for {service}. Use --verbose for more info")
+
+    return cached.service_endpoints.get((service, project, region), fetch)
+
+
+def get_image_digest(image):
+    # From the registry's Docker-Content-Digest header, only Container and Artifact Registry take the
+    # access token like gcloud container images describe does
+    if "@sha256:" in image:
+        return image.split("@", 1)[1]
+
+    host, _, repository = image.partition("/")
+    if not (host.endswith("gcr.io") or host.endswith("-docker.pkg.dev")) or not repository:
+        log.debug(f"Cannot look up the digest of {image}, only gcr.io and pkg.dev registries are supported")
+        return None
+    name, tag = repository.rsplit(":", 1) if ":" in repository.rsplit("/", 1)[-1] else (repository, "latest")
+
+    response_headers = {}
+    try:
+        manifest = request("GET", f"https://{host}/v2/{name}/manifests/{tag}", accept=MANIFEST_TYPES,
+                           response_headers=response_headers)
+    except (ApiError, OSError) as e:
+        log.debug(f"Failed to get the digest of {image}: {e}")
+        return None
+    return response_headers.get("docker-content-digest") if manifest is not None else None
+
+
+def service_url(service, project, region):
+    return (f"https://{region}-run.googleapis.com/apis/serving.knative.dev/v1"
+            f"/namespaces/{project}/services/{service}")
+
+
+def get_access_token():
+    token = tokens.get(tokens.ACCESS)
+    if not token:
+        raise ApiError(401, "could not get gcloud access token, check 'gcloud auth login'")
+    return token
+
+
+def get_connection(host):
+    # http.client connections are not thread-safe, keep one keep-alive connection per host per thread
+    pool = getattr(_connections, "pool", None)
+    if pool is None:
+        pool = _connections.pool = {}
+
+    if host not in pool:
+        if API_ENDPOINT:
+            endpoint = urlsplit(API_ENDPOINT)
+            connection_class = http.HTTPSConnection if endpoint.scheme == "https" else http.HTTPConnection
+            pool[host] = connection_class(endpoint.netloc, timeout=60)
+        else:
+            pool[host] = http.HTTPSConnection(host, timeout=60)
+    return pool[host]
+
+
+def request(method, url, body=None, content_type="application/json", accept=None, response_headers=None):
+    # response_headers, if given, is filled with the response's headers, lowercased
+    parsed = urlsplit(url)
+    path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+    token = get_access_token()
+    headers = {
+        "Host": parsed.netloc,
+        "Authorization": f"Bearer {token}",
+        "Content-Type": content_type,
+    }
+    if accept:
+        headers["Accept"] = accept
+    if hasattr(body, "read"):
+        # Streamed from the file, which is rewound before every attempt
+        body.seek(0, os.SEEK_END)
+        headers["Content-Length"] = str(body.tell())
+    elif body is not None and not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+
+    # Rate limits and transient server errors are retried with backoff, a POST only on 429 since
+    # the server may have acted on it otherwise
+    api = api_name(parsed.netloc)
+    retryable = {429} if method == "POST" else RETRYABLE_STATUSES
+    reconnected = False
+    reauthenticated = False
+    attempt = 0
+    while True:
+        conn = get_connection(parsed.netloc)
+        delay = None
+        try:
+            with throttle.slot(api), span(f"{method} {parsed.netloc}", HTTP):
+                if hasattr(body, "read"):
+                    body.seek(0)
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+        except (http.HTTPException, ConnectionError):
+            conn.close()
+            _connections.pool.pop(parsed.netloc, None)
+            if not reconnected:
+                # Stale keep-alive connection, reconnect right away once
+                reconnected = True
+                continue
+            if attempt == throttle.RETRIES:
+                raise
+        else:
+            if response.status == 401 and not reauthenticated:
+                # The token may have expired earlier than expected, get a new one once
+                reauthenticated = True
+                tokens.invalidate(tokens.ACCESS, token)
+                token = get_access_token()
+                headers["Authorization"] = f"Bearer {token}"
+                continue
+            if response.status not in retryable or attempt == throttle.RETRIES:
+                break
+            if response.status == 429:
+                throttle.rate_limited(api)
+                delay = retry_after(response)
+
+        delay = max(delay or 0, throttle.backoff(attempt))
+        log.debug(f"{method} {url} failed, retrying in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
+
+    if response.status < 400:
+        throttle.succeeded(api)
+    log.debug(f"{method} {url} -> {response.status}")
+    if response_headers is not None:
+        response_headers.update((name.lower(), value) for name, value in response.getheaders())
+    if response.status == 404 and method == "GET":
+        return None
+    if response.status >= 400:
+        try:
+            message = json.loads(data)["error"]["message"]
+        except Exception:
+            message = data.decode(errors="replace")
+        raise ApiError(response.status, message)
+
+    return json.loads(data) if data else {}
+
+
+def api_name(host):
+    # e.g. europe-west1-run.googleapis.com -> run, for per-API rate limits
+    return host.split(".")[0].rsplit("-", 1)[-1]
+
+
+def retry_after(response):
+    try:
+        return float(response.getheader("Retry-After", ""))
+    except ValueError:
+        return None
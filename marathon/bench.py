@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REQUESTS = 1000
+PERCENTILES = [50, 75, 90, 95, 99, 99.9, 100]
+# Buckets keep 2 significant digits of the latency in microseconds, like an HDR histogram
+HISTOGRAM_DIGITS = 2
+COLD_STARTS_SHOWN = 5
+# An open loop sending less than this share of --rate ran out of connections
+RATE_TOLERANCE = 0.95
+# (summary key, label, unit), latencies are compared in milliseconds
+COMPARED = [
+    ("throughput", "Requests/s", ""),
+    ("p50", "p50", "ms"),
+    ("p90", "p90", "ms"),
+    ("p99", "p99", "ms"),
+    ("p999", "p99.9", "ms"),
+    ("max", "max", "ms"),
+    ("errors", "Errors", ""),
+    ("cold_starts", "Cold starts", ""),
+]
+
+
+def run_bench(args):
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not args.service:
+        log.error("Specify a service to benchmark, or two results to compare with --compare OLD NEW")
+        sys.exit(1)
+
+    from marathon import gcloud
+    url, headers = gcloud.invoke_target(args.service, args.region, "bench")
+    if not url:
+        log.error(f"Could not find the endpoint of {args.service}")
+        sys.exit(1)
+
+    requests = args.requests or (None if args.duration else DEFAULT_REQUESTS)
+    mode = f"open loop at {args.rate:g} requests/s" if args.rate else "closed loop"
+    log.info(f"Benchmarking {url}{args.path}, {mode} over {args.concurrency} connections"
+             f"{f' in each of {args.processes} processes' if args.processes > 1 else ''} ...")
+    stats = generate(url, args.request.upper(), args.path, args.data, headers, requests, args.concurrency,
+                     args.duration, args.rate, args.processes)
+    result = report(stats, args.cold_start_factor)
+    if args.rate:
+        check_rate(stats, args.rate, args.concurrency * args.processes)
+
+    if args.out:
+        result.update({
+            "service": args.service,
+            "url": url,
+            "method": args.request.upper(),
+            "path": args.path,
+            "mode": "open" if args.rate else "closed",
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "processes": args.processes,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        })
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        log.info(f"\nResults written to {args.out}")
+
+
+def generate(url, method, path, data, headers, requests, concurrency, duration, rate, processes):
+    # Worker processes each run their share of the requests and rate over their own concurrency connections,
+    # a single process is limited by the GIL at a few thousand requests per second
+    from marathon import load
+    if processes <= 1:
+        return load.run(url, method, path, data, headers, requests, concurrency, duration, rate)
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(load.run, url, method, path, data, headers, share(requests, processes, i),
+                                   concurrency, duration, rate / processes if rate else None)
+                   for i in range(processes)]
+        return load.merge([future.result() for future in futures])
+
+
+def share(total, parts, index):
+    if total is None:
+        return None
+    return total // parts + (1 if index < total % parts else 0)
+
+
+def report(stats, cold_start_factor):
+    from marathon import load
+
+    summary = load.log_stats(stats)
+    buckets = histogram(stats["latencies"])
+    log_distribution(buckets)
+
+    # Requests far slower than the median, usually waiting for a new instance to start
+    threshold = summary["p50"] * cold_start_factor
+    outliers = sorted(((latency, start) for latency, start in zip(stats["latencies"], stats["starts"])
+                       if latency > threshold), reverse=True)
+    summary["cold_starts"] = len(outliers)
+    if outliers:
+        slowest = ", ".join(f"{latency * 1000:.0f}ms at +{start:.1f}s" for latency, start in
+                            outliers[:COLD_STARTS_SHOWN])
+        log.info(f"\nCold start outliers: {len(outliers)} requests slower than {cold_start_factor:g}x p50"
+                 f" ({threshold * 1000:.1f}ms), slowest: {slowest}")
+
+    return {
+        "summary": summary,
+        "statuses": {str(status): count for status, count in stats["statuses"].items()},
+        "errors": stats["errors"],
+        "histogram": {str(bucket): count for bucket, count in sorted(buckets.items())},
+        "cold_starts": {
+            "threshold": threshold,
+            "slowest": [{"latency": latency, "start": start} for latency, start in outliers[:COLD_STARTS_SHOWN]],
+        },
+    }
+
+
+def check_rate(stats, rate, connections):
+    # Requests wait for a free connection once latency x rate exceeds them, the rate then tops out.
+    # Measured until the last request went out, on schedule that's one interval before the next would
+    sent = len(stats["latencies"]) + sum(stats["errors"].values())
+    achieved = sent / (stats["last_sent"] + 1 / rate)
+    if achieved < rate * RATE_TOLERANCE:
+        log.warning((f"\nOnly {achieved:.1f} of the requested {rate:g} requests/s were sent, all {connections}"
+                     " connections were busy. Latencies include the wait for a connection, raise --concurrency"
+                     " for a real open loop"))
+
+
+def histogram(latencies):
+    # {bucket in microseconds: count}
+    buckets = {}
+    for latency in latencies:
+        micros = max(1, int(latency * 1000000))
+        magnitude = 10 ** max(0, len(str(micros)) - HISTOGRAM_DIGITS)
+        bucket = micros // magnitude * magnitude
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    return buckets
+
+
+def log_distribution(buckets):
+    total = sum(buckets.values())
+    if not total:
+        return
+
+    log.info("\nPercentile  Latency      Count")
+    cumulative = 0
+    ordered = sorted(buckets.items())
+    index = 0
+    for percentile in PERCENTILES:
+        while index < len(ordered) and cumulative + ordered[index][1] < percentile / 100 * total:
+            cumulative += ordered[index][1]
+            index += 1
+        bucket, count = ordered[min(index, len(ordered) - 1)]
+        log.info(f"  {percentile:>7.3f}%  {bucket / 1000:>8.2f}ms  {min(total, cumulative + count):>8}")
+
+    # Powers of two in milliseconds, an empty range between two populated ones is still shown
+    ranges = {}
+    for bucket, count in ordered:
+        upper = 1
+        while upper * 1000 <= bucket:
+            upper *= 2
+        ranges[upper] = ranges.get(upper, 0) + count
+    most = max(ranges.values())
+    log.info("")
+    upper = min(ranges)
+    while upper <= max(ranges):
+        count = ranges.get(upper, 0)
+        bar = "#" * max(1 if count else 0, round(count / most * 40))
+        label = f"{upper / 2 if upper > 1 else 0:g}-{upper:g}ms"
+        log.info(f"  {label:>14}  {bar:<40} {count}")
+        upper *= 2
+
+
+def compare(old_path, new_path):
+    try:
+        with open(old_path, "r") as f:
+            old = json.load(f)["summary"]
+        with open(new_path, "r") as f:
+            new = json.load(f)["summary"]
+    except (OSError, ValueError, KeyError) as e:
+        log.error(f"Could not read benchmark results: {e}")
+        sys.exit(1)
+
+    log.info(f"Old: {old_path}\nNew: {new_path}\n")
+    log.info(f"{'':<12} {'old':>14} {'new':>14}   change")
+    for key, label, unit in COMPARED:
+        if key not in old or key not in new:
+            continue
+        scale = 1000 if unit == "ms" else 1
+        before, after = old[key] * scale, new[key] * scale
+        change = f"{(after - before) / before:+.1%}" if before else ""
+        digits = 0 if isinstance(old[key], int) and isinstance(new[key], int) else 1
+        log.info(f"{label:<12} {before:>12.{digits}f}{unit:<2} {after:>12.{digits}f}{unit:<2}   {change}")
@@ -1,3 +1,54 @@
 #!/usr/bin/env python3
 
-marathon_config = {}
+import threading
+
+marathon_source = None
+marathon_config = None
+environment_configs = {}
+
+
+class Cache:
+    def __init__(self):
+        self._values = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Concurrent lookups of the same key wait for a single fetch
+        with key_lock:
+            with self._lock:
+                if key in self._values:
+                    return self._values[key]
+            value = fetch()
+            if value is not None:
+                self.set(key, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def invalidate(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+# (service, project, region) -> url
+service_endpoints = Cache()
+# (service_account_email, project) -> bool
+service_accounts = Cache()
+# (job, project) -> bool
+scheduler_jobs = Cache()
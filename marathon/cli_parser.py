@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import argparse
 
 from marathon.version import description, version
@@ -13,10 +14,74 @@ def init_cli_parser():
     deploy_parser = subparser.add_parser("deploy", help="Deploy services to Cloud Run and setup IAM")
     deploy_parser.add_argument("service", type=str, metavar="SERVICE", nargs="?",
                               help="Service to deploy, default is all", default="all")
+    add_jobs_flag(deploy_parser, "--parallelism", "-p")
+    deploy_parser.add_argument("--force", "-f", action="store_true", default=False,
+                              help="Deploy even if the image and configuration are unchanged")
+    deploy_parser.add_argument("--env", "-e", type=str, default=None,
+                              help=("Comma separated environments of run.yaml to deploy concurrently,"
+                                    " or 'all'"))
+    deploy_parser.add_argument("--canary", action="store_true", default=False,
+                              help=("Shift traffic to new revisions in the steps of each service's 'rollout'"
+                                    " block, probing them in between and rolling back if they are unhealthy"))
+    add_backend_flag(deploy_parser)
+
+    plan_parser = subparser.add_parser("plan", help="Show what 'run deploy' would do and how long it would take")
+    plan_parser.add_argument("service", type=str, metavar="SERVICE", nargs="?",
+                             help="Service to plan, default is all", default="all")
+    plan_parser.add_argument("--out", "-o", type=str, metavar="FILE", default=None,
+                             help="Write the plan as JSON for 'run apply'")
+    plan_parser.add_argument("--build", action="store_true", default=False,
+                             help="Also build the services whose source changed since their last successful build")
+    plan_parser.add_argument("--force", "-f", action="store_true", default=False,
+                             help="Deploy even if the image and configuration are unchanged")
+    plan_parser.add_argument("--canary", action="store_true", default=False,
+                             help="Roll out new revisions gradually when the plan is applied")
+    add_jobs_flag(plan_parser)
+    add_backend_flag(plan_parser)
+
+    apply_parser = subparser.add_parser("apply", help="Execute a plan written by 'run plan --out'")
+    apply_parser.add_argument("plan", type=str, metavar="PLAN", help="Plan JSON file")
+    add_jobs_flag(apply_parser)
+
+    ship_parser = subparser.add_parser("ship", help="Build and deploy services, each as soon as its image is built")
+    ship_parser.add_argument("service", type=str, metavar="SERVICE", nargs="?",
+                             help="Service to build and deploy, default is all", default="all")
+    ship_parser.add_argument("--changed-only", action="store_true", default=False,
+                             help=("Only build services whose source changed since the last successful build,"
+                                   " the others are deployed with the image they have"))
+    ship_parser.add_argument("--force", "-f", action="store_true", default=False,
+                             help="Deploy even if the image and configuration are unchanged")
+    ship_parser.add_argument("--canary", action="store_true", default=False,
+                             help="Roll out new revisions gradually, see 'run deploy --canary'")
+    add_jobs_flag(ship_parser)
+    add_backend_flag(ship_parser)
 
     build_parser = subparser.add_parser("build", help="Build containers using Cloud Build")
     build_parser.add_argument("service", type=str, metavar="SERVICE", nargs="?",
                               help="Service to build, default is all", default="all")
+    build_parser.add_argument("--changed-only", action="store_true", default=False,
+                              help=("Only build services whose source changed since the last"
+                                    " successful build, honoring .gcloudignore and .dockerignore"))
+    build_parser.add_argument("--combined", action="store_true", default=False,
+                              help=("Build all services as parallel steps of one Cloud Build, uploading the"
+                                    " directory that contains all of their dirs"))
+    build_parser.add_argument("--write-config", action="store_true", default=False,
+                              help=("Write the generated cloudbuild.yaml to the dir of each service, or with"
+                                    " --combined one for all of them, instead of building"))
+    add_jobs_flag(build_parser)
+    add_backend_flag(build_parser)
+
+    watch_parser = subparser.add_parser("watch", help="Build and deploy services whenever their source changes")
+    watch_parser.add_argument("services", type=str, metavar="SERVICE", nargs="*",
+                              help="Services to watch, default is all with a 'dir'")
+    watch_parser.add_argument("--debounce", type=float, default=0.5,
+                              help="Seconds without changes to wait for before building, default is 0.5")
+    watch_parser.add_argument("--polling", action="store_true", default=False,
+                              help="Poll for changes instead of using inotify")
+    watch_parser.add_argument("--poll-interval", type=float, default=1.0,
+                              help="Seconds between scans when polling, default is 1")
+    add_jobs_flag(watch_parser)
+    add_backend_flag(watch_parser)
 
     init_parser = subparser.add_parser("init", help="Create an example run.yaml")
 
@@ -33,15 +98,86 @@ def init_cli_parser():
     invoke_parser.add_argument("service", type=str, metavar="SERVICE", help="Service name")
     invoke_parser.add_argument("--path", "-p", type=str, help="Request path, default is /", default="/")
     invoke_parser.add_argument("--request", "-X", type=str, help="Request method, default is GET", default="GET")
-    invoke_parser.add_argument("--data", "-d", type=str, help="Request json data, default is \"\"", default="")
+    invoke_parser.add_argument("--data", "-d", type=str, default="",
+                               help="Request json data or @file to stream it from disk, default is \"\"")
+    invoke_parser.add_argument("--output", "-o", type=str, default=None,
+                               help="Stream the response to this file instead of stdout")
+    invoke_parser.add_argument("--repeat", "-n", type=int, default=1,
+                               help=("Send the request this many times and report throughput and latency"
+                                     " percentiles instead of the response, default is 1"))
+    invoke_parser.add_argument("--concurrency", "-c", type=int, default=1,
+                               help="Number of concurrent keep-alive connections with --repeat, default is 1")
     invoke_parser.add_argument("--region", "-r", type=str, help="Service region", default="")
 
-    add_verbose_quiet_flags([deploy_parser, build_parser, init_parser, check_parser, list_parser,
-        describe_parser, invoke_parser])
+    bench_parser = subparser.add_parser("bench",
+                                        help="Benchmark the latency and throughput of a Cloud Run service")
+    bench_parser.add_argument("service", type=str, metavar="SERVICE", nargs="?", help="Service name")
+    bench_parser.add_argument("--path", "-p", type=str, help="Request path, default is /", default="/")
+    bench_parser.add_argument("--request", "-X", type=str, help="Request method, default is GET", default="GET")
+    bench_parser.add_argument("--data", "-d", type=str, default="",
+                              help="Request json data or @file to stream it from disk, default is \"\"")
+    bench_parser.add_argument("--requests", "-n", type=int, default=None,
+                              help="Number of requests to send, default is 1000 unless --duration is set")
+    bench_parser.add_argument("--duration", "-t", type=float, default=None,
+                              help="Send requests for this many seconds instead of a number of requests")
+    bench_parser.add_argument("--concurrency", "-c", type=int, default=10,
+                              help="Number of keep-alive connections per process, default is 10")
+    bench_parser.add_argument("--rate", type=float, default=None,
+                              help=("Send this many requests per second whether or not earlier ones finished"
+                                    " (open loop), at most --concurrency in flight per process, default is to"
+                                    " send the next request when one finishes"))
+    bench_parser.add_argument("--processes", type=int, default=1,
+                              help="Number of processes sharing the load, default is 1")
+    bench_parser.add_argument("--cold-start-factor", type=float, default=5.0,
+                              help=("Report requests this many times slower than the median as cold starts,"
+                                    " default is 5"))
+    bench_parser.add_argument("--out", "-o", type=str, metavar="FILE", default=None,
+                              help="Write the results as JSON, to compare them later")
+    bench_parser.add_argument("--compare", type=str, nargs=2, metavar=("OLD", "NEW"), default=None,
+                              help="Compare two results written with --out instead of benchmarking")
+    bench_parser.add_argument("--region", "-r", type=str, help="Service region", default="")
+
+    add_profile_flags([deploy_parser, apply_parser, ship_parser, build_parser])
+    add_prefetch_flag([deploy_parser, plan_parser, ship_parser])
+    add_verbose_quiet_flags([deploy_parser, plan_parser, apply_parser, ship_parser, build_parser, watch_parser,
+                             init_parser, check_parser, list_parser, describe_parser, invoke_parser, bench_parser])
 
     return parser
 
 
+def add_jobs_flag(parser, *aliases):
+    parser.add_argument("--jobs", "-j", *aliases, type=int, dest="jobs", default=None,
+                        help=("Maximum number of services to process at once, default is based"
+                              " on available CPUs and memory"))
+    parser.add_argument("--max-procs", type=int, default=None,
+                        help=("Maximum number of concurrent gcloud processes or API requests across all"
+                              " services, default is based on available CPUs and memory"))
+    parser.add_argument("--max-rate", type=float, default=None,
+                        help="Maximum gcloud processes or API requests started per second, default is no limit")
+
+
+def add_backend_flag(parser):
+    parser.add_argument("--backend", type=str, choices=["gcloud", "api"],
+                        default=os.environ.get("MARATHON_BACKEND", "gcloud"),
+                        help=("Use the gcloud CLI or call the Google Cloud REST APIs directly,"
+                              " default is $MARATHON_BACKEND or gcloud"))
+
+
+def add_profile_flags(parsers):
+    for parser in parsers:
+        parser.add_argument("--profile", action="store_true", default=False,
+                            help="Print a per-service, per-step timing breakdown at the end")
+        parser.add_argument("--trace-out", type=str, metavar="FILE", default=None,
+                            help="Write a Chrome trace-event JSON file of every step and gcloud call")
+
+
+def add_prefetch_flag(parsers):
+    for parser in parsers:
+        parser.add_argument("--no-prefetch", action="store_true", default=False,
+                            help=("Look up endpoints, service accounts and scheduler jobs one call at a time"
+                                  " instead of listing them up front"))
+
+
 def add_verbose_quiet_flags(parsers):
     for parser in parsers:
         parser.add_argument("--verbose", "-v", help="Set verbose mode (debug)",
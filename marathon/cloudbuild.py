@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import posixpath
+
+from marathon.config import ConfigError
+
+DOCKER_BUILDER = "gcr.io/cloud-builders/docker"
+KANIKO_BUILDER = "gcr.io/kaniko-project/executor:latest"
+CACHE_MODES = ("docker", "kaniko", "none")
+DEFAULTS = {
+    "cache": "docker",
+    "machine-type": None,
+    "timeout": None,
+}
+TIMEOUT_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+def settings(service):
+    # The service's 'build' block on top of the defaults, 'cache' is docker, kaniko or none
+    build = service.build or {}
+    if not isinstance(build, dict):
+        raise ConfigError(f"'{service.name}.build' in run.yaml must be a mapping")
+    unknown = sorted(set(build) - set(DEFAULTS))
+    if unknown:
+        raise ConfigError(f"Unknown keys in '{service.name}.build' in run.yaml: {', '.join(unknown)}")
+
+    conf = {**DEFAULTS, **build}
+    if conf["cache"] is True or conf["cache"] is False:
+        conf["cache"] = "docker" if conf["cache"] else "none"
+    conf["cache"] = str(conf["cache"]).lower()
+    if conf["cache"] not in CACHE_MODES:
+        raise ConfigError(f"'{service.name}.build.cache' in run.yaml must be one of {', '.join(CACHE_MODES)}")
+    if conf["machine-type"] is not None:
+        conf["machine-type"] = str(conf["machine-type"]).upper()
+    if conf["timeout"] is not None:
+        conf["timeout"] = timeout_seconds(service, conf["timeout"])
+    return conf
+
+
+def timeout_seconds(service, timeout):
+    # 1200, '1200s', '20m' or '1h'
+    match = re.fullmatch(r"(\d+)([smh]?)", str(timeout).strip())
+    if not match or int(match.group(1)) <= 0:
+        raise ConfigError(f"Invalid '{service.name}.build.timeout' in run.yaml: {timeout}")
+    return int(match.group(1)) * TIMEOUT_UNITS[match.group(2) or "s"]
+
+
+def source_dir(services):
+    # The directory uploaded for a build, the closest one containing the dirs of all services
+    return os.path.relpath(os.path.commonpath([os.path.abspath(service.dir) for service in services]))
+
+
+def config(services, root=None):
+    # Cloud Build config building the images of the services as parallel steps of one build,
+    # with the source uploaded from root
+    root = root or source_dir(services)
+    steps = []
+    images = []
+    machine_types = []
+    timeouts = []
+    for service in services:
+        conf = settings(service)
+        dir = os.path.relpath(service.dir, root).replace(os.sep, "/")
+        steps.extend(build_steps(service, conf, dir))
+        # Kaniko pushes the image itself
+        if conf["cache"] != "kaniko":
+            images.append(service.image)
+        if conf["machine-type"]:
+            machine_types.append(conf["machine-type"])
+        if conf["timeout"]:
+            timeouts.append(conf["timeout"])
+
+    build = {"steps": steps}
+    if images:
+        build["images"] = images
+    if machine_types:
+        build["options"] = {"machineType": max(machine_types, key=machine_cpus)}
+    if timeouts:
+        build["timeout"] = f"{max(timeouts)}s"
+    return build
+
+
+def build_steps(service, conf, dir):
+    step = service.sanitized_name
+    if conf["cache"] == "kaniko":
+        context = posixpath.normpath(posixpath.join("/workspace", dir))
+        return [{
+            "id": f"build-{step}",
+            "name": KANIKO_BUILDER,
+            "args": [f"--destination={service.image}", f"--context=dir://{context}", "--cache=true"],
+            "waitFor": ["-"],
+        }]
+
+    build = {"id": f"build-{step}", "name": DOCKER_BUILDER, "args": ["build", "-t", service.image]}
+    if dir != ".":
+        build["dir"] = dir
+    if conf["cache"] == "none":
+        build["args"].append(".")
+        build["waitFor"] = ["-"]
+        return [build]
+
+    # The previous image is the layer cache, the first build of an image has nothing to pull
+    pull = {
+        "id": f"pull-{step}",
+        "name": DOCKER_BUILDER,
+        "entrypoint": "bash",
+        "args": ["-c", f"docker pull {service.image} || exit 0"],
+        "waitFor": ["-"],
+    }
+    build["args"].extend(["--cache-from", service.image, "--build-arg", "BUILDKIT_INLINE_CACHE=1", "."])
+    build["waitFor"] = [pull["id"]]
+    return [pull, build]
+
+
+def machine_cpus(machine_type):
+    # E2_HIGHCPU_32 -> 32, for picking the largest machine type of a combined build
+    match = re.search(r"_(\d+)$", machine_type)
+    return int(match.group(1)) if match else 1
+
+
+def image_digests(build):
+    # {image: digest} of the images pushed by a finished build
+    return {image["name"]: image["digest"] for image in (build.get("results") or {}).get("images") or []
+            if image.get("name") and image.get("digest")}
+
+
+def to_yaml(build):
+    import yaml
+    return yaml.safe_dump(build, sort_keys=False, default_flow_style=False)
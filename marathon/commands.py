@@ -0,0 +1,756 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import logging
+import importlib
+
+from marathon.config import ConfigError
+from marathon.utils import get_marathon_config, get_environment_config, environment_names, service_iter
+from marathon.scheduler import run_dag, log_summary, default_jobs, OK, SKIPPED, FAILED, CANCELLED
+from marathon import iam, state, profiler, throttle
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ("gcloud", "api")
+
+
+def get_backend(name):
+    # Only the selected backend is imported, the api one pulls in http.client
+    return importlib.import_module(f"marathon.{name}")
+
+
+def setup_backend(args, name=None):
+    # The backend (--backend unless given) and --jobs, with the limits on concurrent gcloud calls or requests
+    throttle.configure(args.max_procs or default_jobs(), args.max_rate)
+    return get_backend(name or args.backend), args.jobs or default_jobs()
+
+
+def run_deploy(args):
+    if args.env:
+        deploy_environments(args)
+        return
+
+    conf = load_config([] if args.service == "all" else [args.service])
+    project = conf.project
+
+    log.info(f"Deployment status: https://console.cloud.google.com/run?project={project}")
+
+    backend, jobs = setup_backend(args)
+    services = list(service_iter()) if args.service == "all" else [args.service]
+    # Services with several regions get one target per region, e.g. 'service1@europe-west1'
+    targets, targets_deps = load_targets(conf, services)
+    check_settings(targets.values(), args.canary)
+    iam_plan = setup_iam(backend, targets.values(), jobs, not args.no_prefetch)
+
+    if len(targets) == 1:
+        if not deploy_service(backend, next(iter(targets.values())), iam_plan, args.force, args.canary):
+            sys.exit(1)
+    else:
+        if args.service != "all":
+            targets_deps = {target: set() for target in targets}
+
+        try:
+            results = run_dag(targets_deps,
+                              lambda target: deploy_service(backend, targets[target], iam_plan, args.force,
+                                                             args.canary),
+                              jobs)
+        except KeyboardInterrupt:
+            log.error("\nDeployments cancelled\n")
+            sys.exit(1)
+
+        log_summary(results, "Deployment summary")
+        log_endpoints(backend, targets, results)
+        if any(status in (FAILED, CANCELLED) for status, _ in results.values()):
+            log.error("\nDeployments failed\n")
+            sys.exit(1)
+
+    log.info("\nDeployments finished\n")
+
+
+def load_config(services):
+    try:
+        conf = get_marathon_config()
+        conf["project"]
+    except ConfigError as e:
+        log.error(e)
+        sys.exit(1)
+    except Exception as e:
+        log.error(e)
+        log.info("You can create an example run.yaml with 'run init'")
+        sys.exit(1)
+
+    for service in services:
+        if service not in conf.services:
+            log.error(f"Service {service} not found in run.yaml")
+            sys.exit(1)
+    return conf
+
+
+def load_targets(conf, services):
+    try:
+        return conf.targets(services)
+    except ConfigError as e:
+        log.error(e)
+        sys.exit(1)
+
+
+def load_environments(names, services):
+    # {environment: MarathonConfig}, run.yaml is parsed once and each environment merged over it
+    try:
+        if names == ["all"]:
+            names = environment_names()
+        envs = {name: get_environment_config(name) for name in names}
+    except ConfigError as e:
+        log.error(e)
+        sys.exit(1)
+    except Exception as e:
+        log.error(e)
+        log.info("You can create an example run.yaml with 'run init'")
+        sys.exit(1)
+
+    if not envs:
+        log.error("No environments found in run.yaml")
+        sys.exit(1)
+    for name, env_conf in envs.items():
+        if not env_conf.project:
+            log.error(f"No 'project' for environment {name} in run.yaml")
+            sys.exit(1)
+        for service in services:
+            if service not in env_conf.services:
+                log.error(f"Service {service} not found in environment {name} of run.yaml")
+                sys.exit(1)
+    return envs
+
+
+def deploy_environments(args):
+    # Every environment's IAM setup and deploys are nodes of one DAG, bounded by --jobs
+    envs = load_environments([name.strip() for name in args.env.split(",") if name.strip()],
+                             [] if args.service == "all" else [args.service])
+
+    backend, jobs = setup_backend(args)
+    targets = {}
+    env_targets = {}
+    deps_map = {}
+    deployed_by = {}
+    for name, env_conf in envs.items():
+        services = list(env_conf.services) if args.service == "all" else [args.service]
+        env_targets[name], env_deps = load_targets(env_conf, services)
+        # Two environments deploying the same Cloud Run service would race and overwrite each other
+        for service in env_targets[name].values():
+            key = (service.project, service.region, service.sanitized_name)
+            if key in deployed_by:
+                log.error((f"Environments {deployed_by[key]} and {name} both deploy {service.sanitized_name}"
+                           f" to {service.project} in {service.region}, give them different projects or regions"))
+                sys.exit(1)
+            deployed_by[key] = name
+        if args.service != "all":
+            env_deps = {target: set() for target in env_targets[name]}
+        deps_map[iam_node(name)] = set()
+        for target, deps in env_deps.items():
+            deps_map[target] = deps | {iam_node(name)}
+        targets.update(env_targets[name])
+    check_settings(targets.values(), args.canary)
+    for name, env_conf in envs.items():
+        log.info(f"Deployment status of {name}: https://console.cloud.google.com/run?project={env_conf.project}")
+
+    iam_plans = {}
+
+    def deploy_node(node):
+        if node in targets:
+            service = targets[node]
+            return deploy_service(backend, service, iam_plans[service.environment], args.force, args.canary)
+
+        name = node.split(":", 1)[1]
+        try:
+            iam_plans[name] = prepare_iam(backend, env_targets[name].values(), jobs, not args.no_prefetch,
+                                          conf=envs[name])
+        except iam.IamError as e:
+            log.error(f"{name}: {e}")
+            log.error(f"Deployment of {name} failed: Could not set up IAM service accounts and bindings")
+            return False
+        return True
+
+    try:
+        results = run_dag(deps_map, deploy_node, jobs)
+    except KeyboardInterrupt:
+        log.error("\nDeployments cancelled\n")
+        sys.exit(1)
+
+    log_summary(results, "Deployment summary")
+    log_endpoints(backend, targets, {target: results[target] for target in targets})
+    if any(status in (FAILED, CANCELLED) for status, _ in results.values()):
+        log.error("\nDeployments failed\n")
+        sys.exit(1)
+
+    log.info("\nDeployments finished\n")
+
+
+def iam_node(environment):
+    return f"iam:{environment}"
+
+
+def check_settings(targets, canary):
+    # The rollout and warmup blocks are validated before anything is deployed
+    from marathon import rollout, warmup
+    try:
+        for service in targets:
+            warmup.settings(service)
+            if canary:
+                rollout.settings(service)
+    except ConfigError as e:
+        log.error(e)
+        sys.exit(1)
+
+
+def setup_iam(backend, targets, jobs, prefetch_lookups=True, iam_plan=None):
+    try:
+        return prepare_iam(backend, targets, jobs, prefetch_lookups, iam_plan)
+    except iam.IamError as e:
+        log.error(e)
+        log.error("Deployment failed: Could not set up IAM service accounts and bindings")
+        sys.exit(1)
+
+
+def prepare_iam(backend, targets, jobs, prefetch_lookups=True, iam_plan=None, conf=None):
+    conf = conf or get_marathon_config()
+    start = time.monotonic()
+    with profiler.span("iam setup"):
+        if iam_plan is None:
+            iam_plan = iam.plan(targets, conf)
+            if prefetch_lookups:
+                with profiler.span("prefetch"):
+                    prefetch(backend, iam_plan, targets, conf.project)
+        iam.prepare(backend, *iam_plan, targets, jobs, conf.project)
+    state.write("durations", f"iam/{conf.project}", round(time.monotonic() - start, 1))
+    return iam_plan
+
+
+def prefetch(backend, iam_plan, targets, project=None):
+    project = project or get_marathon_config().project
+    service_accounts = [iam.service_account_email(name, project) for name in iam_plan[0]]
+    jobs = sorted({f"{service.sanitized_name}-job" for service in targets if service.cron})
+    regions = sorted({service.region for service in targets})
+    backend.prefetch(project, regions, service_accounts, jobs)
+
+
+def log_endpoints(backend, targets, results):
+    listed = [target for target, service in targets.items() if len(service.regions) > 1 or service.environment]
+    if not listed:
+        return
+
+    log.info("\nEndpoints:")
+    for target in sorted(listed):
+        service = targets[target]
+        name = f"{service.environment}/{service.name}" if service.environment else service.name
+        url = None
+        if results[target][0] in (OK, SKIPPED):
+            url = backend.get_service_endpoint(service.sanitized_name, service.project, service.region)
+        log.info(f"  {name:<24} {service.region:<24} {url or results[target][0]}")
+
+
+def deploy_service(backend, service, iam_plan, force, canary=False):
+    from marathon.utils import pin_image
+
+    key = state.service_key(service.name, service.project, service.region)
+    with profiler.service_context(service.target):
+        with profiler.span("fingerprint"):
+            digest = backend.get_image_digest(service.image) if service.image else None
+            # Deployed by digest, so Cloud Run doesn't resolve the tag again
+            if digest:
+                service.image = pin_image(service.image, digest)
+            fingerprint = state.deploy_fingerprint(backend, service, iam_plan, digest)
+        if not force and fingerprint and state.read("deploys", key) == fingerprint:
+            log.info(f"Skipping {service.target}: Image and configuration unchanged since last deploy")
+            return SKIPPED
+
+    return deploy_target(backend, service, iam_plan, fingerprint, canary)
+
+
+def deploy_target(backend, service, iam_plan, fingerprint, canary=False):
+    key = state.service_key(service.name, service.project, service.region)
+    with profiler.service_context(service.target):
+        log.info(f"Deploying {service.target} ...")
+        start = time.monotonic()
+        if not backend.deploy(service, iam_plan, canary):
+            return False
+    state.write("durations", f"deploy/{key}", round(time.monotonic() - start, 1))
+    if fingerprint:
+        state.write("deploys", key, fingerprint)
+    return True
+
+
+def run_plan(args):
+    from marathon import plan
+
+    conf = load_config([] if args.service == "all" else [args.service])
+    backend, jobs = setup_backend(args)
+    services = list(service_iter()) if args.service == "all" else [args.service]
+    targets, targets_deps = load_targets(conf, services)
+    if args.service != "all":
+        targets_deps = {target: set() for target in targets}
+    check_settings(targets.values(), args.canary)
+
+    iam_plan = iam.plan(targets.values())
+    if not args.no_prefetch:
+        prefetch(backend, iam_plan, targets.values())
+
+    builds = {}
+    if args.build:
+        check_build_settings(conf, services)
+        builds, failed = select_builds(conf, services, True, {})
+        if failed:
+            sys.exit(1)
+
+    digests = resolve_digests(backend, {service.image for service in targets.values()
+                               if service.image and service.name not in builds}, jobs)
+
+    result = plan.create(conf, args.backend, args.service, targets, targets_deps, iam_plan, builds, digests,
+                         backend, args.force, args.canary)
+    log.info("")
+    plan.log_plan(result, jobs)
+    if args.out:
+        plan.write(result, args.out)
+        log.info(f"\nPlan written to {args.out}, run 'run apply {args.out}' to execute it")
+
+
+def resolve_digests(backend, images, jobs):
+    # {image: digest or None}, looked up concurrently
+    from concurrent.futures import ThreadPoolExecutor
+
+    images = sorted(images)
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(images)))) as executor:
+        return dict(zip(images, executor.map(backend.get_image_digest, images)))
+
+
+def run_apply(args):
+    from marathon import plan
+    from marathon.config import MarathonConfig
+    from marathon.utils import pin_image
+    import marathon.cached as cached
+
+    try:
+        plan_data = plan.read(args.plan)
+        conf = MarathonConfig(plan_data["config"])
+        if plan_data["backend"] not in BACKENDS:
+            raise ValueError(f"unknown backend {plan_data['backend']!r}, expected one of {', '.join(BACKENDS)}")
+        # A cycle would otherwise only be found after the IAM setup, toposort raises it as a ValueError
+        node_deps, _ = plan.graph(plan_data)
+        plan.waves(node_deps)
+    except (OSError, ValueError, KeyError, ConfigError) as e:
+        log.error(f"Could not read plan {args.plan}: {e}")
+        sys.exit(1)
+    if os.path.exists("run.yaml"):
+        try:
+            if get_marathon_config().raw != conf.raw:
+                log.warning("run.yaml changed since the plan was created, applying the plan as it is")
+        except Exception as e:
+            log.debug(e)
+    # The plan replaces run.yaml and the lookups, nothing is computed again
+    cached.marathon_config = conf
+    plan.seed_lookups(plan_data)
+
+    log.info(f"Applying plan created at {plan_data['created']} ...")
+    log.info(f"Deployment status: https://console.cloud.google.com/run?project={conf.project}")
+
+    backend, jobs = setup_backend(args, plan_data["backend"])
+    services = sorted({entry["service"] for entry in plan_data["targets"].values()})
+    all_targets, _ = load_targets(conf, services)
+    targets = {}
+    for target, entry in plan_data["targets"].items():
+        targets[target] = all_targets[target]
+        targets[target].image = entry["image"]
+    iam_plan = setup_iam(backend, targets.values(), jobs, iam_plan=plan.iam_plan(plan_data))
+    digests = {}
+
+    def apply_node(node):
+        if node not in plan_data["targets"]:
+            name = node.split(":", 1)[1]
+            return build_service(backend, name, plan_data["builds"][name]["fingerprint"], digests)
+
+        entry = plan_data["targets"][node]
+        if entry["action"] == plan.SKIP:
+            log.info(f"Skipping {node}: {entry['reason'].capitalize()}")
+            return SKIPPED
+        service = targets[node]
+        fingerprint = entry["fingerprint"]
+        if entry["build"]:
+            # The digest of a rebuilt image is only known now
+            digest = digests.get(service.image)
+            if not digest:
+                log.error(f"Failed to deploy {node}: Could not resolve the digest of {service.image}")
+                return False
+            service.image = pin_image(service.image, digest)
+            fingerprint = state.deploy_fingerprint(backend, service, iam_plan, digest)
+        return deploy_target(backend, service, iam_plan, fingerprint, plan_data["canary"])
+
+    try:
+        results = run_dag(node_deps, apply_node, jobs)
+    except KeyboardInterrupt:
+        log.error("\nApply cancelled\n")
+        sys.exit(1)
+
+    log_summary(results, "Apply summary")
+    log_endpoints(backend, targets, {node: results[node] for node in targets})
+    if any(status in (FAILED, CANCELLED) for status, _ in results.values()):
+        log.error("\nApply failed\n")
+        sys.exit(1)
+
+    log.info("\nPlan applied\n")
+
+
+def run_ship(args):
+    # Builds and deploys in one DAG: a service deploys as soon as its own image is built and its IAM is
+    # set up, while other builds are still running, always pinned to the digest of the image
+    from marathon.plan import build_node
+    from marathon.utils import pin_image
+
+    conf = load_config([] if args.service == "all" else [args.service])
+    project = conf.project
+
+    log.info(f"Build logs: https://console.cloud.google.com/cloud-build/builds?project={project}")
+    log.info(f"Deployment status: https://console.cloud.google.com/run?project={project}")
+
+    backend, jobs = setup_backend(args)
+    services = list(service_iter()) if args.service == "all" else [args.service]
+    targets, targets_deps = load_targets(conf, services)
+    if args.service != "all":
+        targets_deps = {target: set() for target in targets}
+    check_settings(targets.values(), args.canary)
+    check_build_settings(conf, services)
+
+    skipped = {}
+    builds, failed = select_builds(conf, services, args.changed_only, skipped)
+    if failed:
+        sys.exit(1)
+    # Images that aren't rebuilt are pinned to the digest their tag points to now
+    built = {conf.services[name].image: name for name in builds}
+    digests = resolve_digests(backend, {service.image for service in targets.values()
+                               if service.image and service.image not in built}, jobs)
+
+    deps_map = {iam_node(project): set()}
+    for name in builds:
+        deps_map[build_node(name)] = set()
+    for target, deps in targets_deps.items():
+        deps_map[target] = deps | {iam_node(project)}
+        if targets[target].image in built:
+            deps_map[target].add(build_node(built[targets[target].image]))
+
+    builds_nodes = {build_node(name): name for name in builds}
+    iam_plans = {}
+
+    def ship_node(node):
+        if node in builds_nodes:
+            name = builds_nodes[node]
+            return build_service(backend, name, builds[name], digests)
+        if node == iam_node(project):
+            try:
+                iam_plans[project] = prepare_iam(backend, targets.values(), jobs, not args.no_prefetch)
+            except iam.IamError as e:
+                log.error(e)
+                log.error("Deployment failed: Could not set up IAM service accounts and bindings")
+                return False
+            return True
+
+        service = targets[node]
+        if service.image:
+            if not digests.get(service.image):
+                log.error(f"Failed to deploy {node}: Could not resolve the digest of {service.image}")
+                return False
+            service.image = pin_image(service.image, digests[service.image])
+        return deploy_service(backend, service, iam_plans[project], args.force, args.canary)
+
+    try:
+        results = run_dag(deps_map, ship_node, jobs)
+    except KeyboardInterrupt:
+        log.error("\nShip cancelled\n")
+        sys.exit(1)
+
+    log_summary(results, "Ship summary")
+    log_endpoints(backend, targets, {target: results[target] for target in targets})
+    if any(status in (FAILED, CANCELLED) for status, _ in results.values()):
+        log.error("\nShip failed\n")
+        sys.exit(1)
+
+    log.info("\nShip finished\n")
+
+
+def run_build(args):
+    conf = load_config([] if args.service == "all" else [args.service])
+    project = conf.project
+    services = list(service_iter()) if args.service == "all" else [args.service]
+    check_build_settings(conf, services)
+    if args.write_config:
+        write_build_configs(conf, services, args.combined)
+        return
+
+    log.info(("Build logs: https://console.cloud.google.com/cloud-build/"
+        f"builds?project={project}"))
+
+    backend, jobs = setup_backend(args)
+    skipped = {}
+    if args.service != "all":
+        fingerprint = build_fingerprint(args.service, args.changed_only, skipped)
+        if args.service not in skipped:
+            if not build_service(backend, args.service, fingerprint):
+                sys.exit(1)
+    else:
+        builds, failed = select_builds(conf, services, args.changed_only, skipped)
+
+        try:
+            if args.combined and builds:
+                results = build_combined(backend, builds)
+            else:
+                results = run_dag({service: set() for service in builds},
+                                  lambda service: build_service(backend, service, builds[service]), jobs)
+        except KeyboardInterrupt:
+            log.error("\nBuilds cancelled\n")
+            sys.exit(1)
+
+        for service in skipped:
+            results[service] = (SKIPPED, 0.0)
+        log_summary(results, "Build summary")
+        failed = failed or any(status == FAILED for status, _ in results.values())
+
+    if args.changed_only and skipped:
+        log.info("\nSkipped builds:")
+        for service, reason in skipped.items():
+            log.info(f"  {service}: {reason}")
+
+    if args.service == "all" and failed:
+        log.error("\nBuilds failed\n")
+        sys.exit(1)
+
+    log.info("\nBuilds finished\n")
+
+
+def check_build_settings(conf, services):
+    # The build blocks are validated before anything is built
+    from marathon import cloudbuild
+    try:
+        for service in services:
+            cloudbuild.settings(conf.services[service])
+    except ConfigError as e:
+        log.error(e)
+        sys.exit(1)
+
+
+def write_build_configs(conf, services, combined):
+    # cloudbuild.yaml in the dir of every service, or one for all of them in the dir containing theirs
+    from marathon import cloudbuild
+
+    builds, failed = select_builds(conf, services, False, {})
+    if failed:
+        sys.exit(1)
+    for names in [sorted(builds)] if combined and builds else [[name] for name in sorted(builds)]:
+        service_confs = [conf.services[name] for name in names]
+        root = cloudbuild.source_dir(service_confs)
+        path = os.path.join(root, "cloudbuild.yaml")
+        if os.path.exists(path):
+            log.info(f"{path} already exists, skipping")
+            continue
+        with open(path, "w") as f:
+            f.write(cloudbuild.to_yaml(cloudbuild.config(service_confs, root)))
+        log.info(f"Created {path}, build it with 'gcloud builds submit {root} --config={path}'")
+
+
+def select_builds(conf, services, changed_only, skipped):
+    # {service: source fingerprint} of the services to build, each image is only built once
+    images_built = []
+    builds = {}
+    failed = False
+    for service in services:
+        if not conf.services[service].dir:
+            skipped[service] = "No 'dir' specified in run.yaml"
+            log.info(f"Skipping {service}: {skipped[service]}")
+            continue
+        if not conf.services[service].image:
+            log.error(f"Failed to build {service}: 'image' is required in run.yaml")
+            failed = True
+            continue
+
+        image = conf.services[service].image
+        if image in images_built:
+            skipped[service] = "Image already built in another service"
+            log.info(f"Skipping {service}: {skipped[service]}")
+            continue
+        images_built.append(image)
+
+        fingerprint = build_fingerprint(service, changed_only, skipped)
+        if service in skipped:
+            continue
+
+        builds[service] = fingerprint
+    return builds, failed
+
+
+def build_fingerprint(service, changed_only, skipped):
+    service_conf = get_marathon_config().services[service]
+    if not service_conf.dir or not service_conf.image:
+        return None
+
+    image = service_conf.image
+    try:
+        fingerprint = state.source_fingerprint(service_conf.dir)
+    except OSError as e:
+        log.debug(e)
+        return None
+
+    last_build = state.read("builds", image)
+    if changed_only and last_build == fingerprint:
+        skipped[service] = f"Source unchanged since last successful build of {image}"
+        log.info(f"Skipping {service}: {skipped[service]}")
+    return fingerprint
+
+
+def build_service(backend, service, fingerprint, digests=None):
+    # digests: {image: digest} to add the digest of the pushed image to
+    service_conf = get_marathon_config().services[service]
+    log.info(f"Building {service} ...")
+    start = time.monotonic()
+    with profiler.service_context(service), profiler.span("build"):
+        result = backend.build(service_conf)
+    if not result:
+        return False
+
+    state.write("durations", f"build/{service_conf.image}", round(time.monotonic() - start, 1))
+    if fingerprint:
+        state.write("builds", service_conf.image, fingerprint)
+    if digests is not None:
+        digests[service_conf.image] = result if result is not True else backend.get_image_digest(service_conf.image)
+    return True
+
+
+def build_combined(backend, builds):
+    # All builds as parallel steps of one Cloud Build, they succeed or fail together
+    conf = get_marathon_config()
+    names = sorted(builds)
+    log.info(f"Building {', '.join(names)} in one Cloud Build ...")
+    start = time.monotonic()
+    with profiler.span("build"):
+        digests = backend.build_services([conf.services[name] for name in names])
+    elapsed = time.monotonic() - start
+    if digests is None:
+        return {name: (FAILED, elapsed) for name in names}
+
+    for name in names:
+        state.write("durations", f"build/{conf.services[name].image}", round(elapsed, 1))
+        if builds[name]:
+            state.write("builds", conf.services[name].image, builds[name])
+    return {name: (OK, elapsed) for name in names}
+
+
+def run_watch(args):
+    from concurrent.futures import ThreadPoolExecutor
+    from marathon import watch
+
+    conf = load_config(args.services)
+    services = args.services or list(service_iter())
+    check_build_settings(conf, services)
+
+    watched = {}
+    for name in services:
+        if not conf.services[name].dir:
+            log.info(f"Not watching {name}: No 'dir' specified in run.yaml")
+            continue
+        watched.setdefault(os.path.normpath(conf.services[name].dir), []).append(name)
+    if not watched:
+        log.error("Nothing to watch, specify a 'dir' for the services in run.yaml")
+        sys.exit(1)
+
+    dependants = {name: set() for name in conf.services}
+    for name, service in conf.services.items():
+        for link in service.links:
+            if link in dependants:
+                dependants[link].add(name)
+
+    # Everything that can be deployed: the watched services and, transitively, their dependants
+    deployable = set()
+    stack = [name for names in watched.values() for name in names]
+    while stack:
+        name = stack.pop()
+        if name not in deployable:
+            deployable.add(name)
+            stack.extend(dependants[name])
+
+    backend, jobs = setup_backend(args)
+    targets, _ = load_targets(conf, sorted(deployable))
+    iam_plan = setup_iam(backend, targets.values(), jobs)
+
+    watcher = watch.watcher(list(watched), args.polling, args.poll_interval)
+    log.info(f"Watching {', '.join(sorted(watched))} for changes, press Ctrl+C to stop ...")
+
+    # pending: {service: whether it needs a build}, a service has at most one pipeline in flight,
+    # changes arriving meanwhile are coalesced into a single rerun once it finishes
+    pending = {}
+    running = {}
+    changed_dirs = set()
+    last_change = 0.0
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        while True:
+            changed = watcher.changes(min(args.debounce, 0.25) if changed_dirs or running else 1.0)
+            now = time.monotonic()
+            if changed:
+                changed_dirs |= changed
+                last_change = now
+            if changed_dirs and now - last_change >= args.debounce:
+                for dir in changed_dirs:
+                    for name in watched[dir]:
+                        pending[name] = True
+                changed_dirs = set()
+
+            for future in [future for future in running if future.done()]:
+                name = running.pop(future)
+                if future.result() == OK:
+                    for dependant in dependants[name]:
+                        pending.setdefault(dependant, False)
+
+            busy = set(running.values())
+            for name in sorted(pending):
+                links = conf.services[name].links
+                if name in busy or any(link in busy or link in pending for link in links):
+                    continue
+                build = pending.pop(name)
+                running[executor.submit(watch_pipeline, backend, name, build, iam_plan)] = name
+                busy.add(name)
+    except KeyboardInterrupt:
+        log.info("\nStopping watch ...")
+    finally:
+        watcher.close()
+        # shutdown(cancel_futures=True) needs Python 3.9
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def watch_pipeline(backend, service, build, iam_plan):
+    # Returns OK only if something was deployed, so unchanged services don't trigger their dependants
+    start = time.monotonic()
+    try:
+        if build:
+            skipped = {}
+            fingerprint = build_fingerprint(service, True, skipped)
+            if service in skipped:
+                return SKIPPED
+            if not build_service(backend, service, fingerprint):
+                log.error(f"[{service}] build failed, waiting for the next change ...")
+                return FAILED
+
+        targets, _ = get_marathon_config().targets([service])
+        results = run_dag({target: set() for target in targets},
+                          lambda target: deploy_service(backend, targets[target], iam_plan, False),
+                          len(targets))
+    except Exception as e:
+        log.error(f"[{service}] {e}")
+        return FAILED
+
+    statuses = {status for status, _ in results.values()}
+    if FAILED in statuses:
+        log.error(f"[{service}] deploy failed, waiting for the next change ...")
+        return FAILED
+    if OK not in statuses:
+        return SKIPPED
+    log.info(f"[{service}] deployed in {time.monotonic() - start:.1f}s")
+    return OK
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import os
+import re
+
+# $${var} is left as a literal ${var}, e.g. for variables expanded inside the container
+VAR_REGEX = re.compile(r"(?<!\$)\$\{([^${}]+)\}")
+ESCAPED_VAR = "$${"
+MAX_NESTING = 10
+RESERVED_KEYS = ("project", "region", "regions", "allow-invoke", "environments")
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Resolver:
+    # Resolves ${var} references against first-level scalars of run.yaml, then environment variables
+    __slots__ = ("variables", "resolved")
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.resolved = {}
+
+    def variable(self, name, stack=()):
+        if name in self.resolved:
+            return self.resolved[name]
+        if name in stack:
+            raise ConfigError(f"Circular variable reference in run.yaml: {' -> '.join(stack + (name,))}")
+
+        if name in self.variables:
+            value = self.substitute(str(self.variables[name]), stack + (name,))
+        elif name in os.environ:
+            value = os.environ[name]
+        else:
+            raise ConfigError(f"Unknown variable ${{{name}}} in run.yaml, it's neither a first-level"
+                              " value nor an environment variable")
+        self.resolved[name] = value
+        return value
+
+    def substitute(self, string, stack=()):
+        # Innermost references are replaced first, so ${${env}-project} works too
+        for _ in range(MAX_NESTING):
+            if not VAR_REGEX.search(string):
+                return string
+            string = VAR_REGEX.sub(lambda match: self.variable(match.group(1), stack), string)
+        raise ConfigError(f"Too deeply nested variable references in run.yaml: {string}")
+
+    def resolve(self, value):
+        if isinstance(value, str):
+            # Escapes are only unescaped once the whole value is substituted
+            return self.substitute(value).replace(ESCAPED_VAR, "${")
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        if isinstance(value, dict):
+            return {self.resolve(key): self.resolve(item) for key, item in value.items()}
+        return value
+
+
+def escape(value):
+    # A resolved config as run.yaml values, so resolving it again leaves literal ${var} alone
+    if isinstance(value, str):
+        return value.replace("${", ESCAPED_VAR)
+    if isinstance(value, list):
+        return [escape(item) for item in value]
+    if isinstance(value, dict):
+        return {escape(key): escape(item) for key, item in value.items()}
+    return value
+
+
+class ServiceConfig:
+    __slots__ = ("name", "target", "environment", "sanitized_name", "project", "region", "regions", "image",
+                 "dir", "authenticated", "concurrency", "max_instances", "min_instances", "cpu", "cpu_boost",
+                 "memory", "timeout", "port", "command", "args", "vpc_connector", "env", "labels",
+                 "cloudsql_instances", "iam_roles", "links", "link_regions", "cron", "rollout", "warmup", "build",
+                 "raw")
+
+    def __init__(self, name, raw, project, regions, environment=None):
+        self.name = name
+        self.environment = environment
+        self.target = f"{environment}/{name}" if environment else name
+        self.sanitized_name = name.lower().replace("_", "-")
+        self.project = project
+        if raw.get("regions"):
+            self.regions = [str(region) for region in raw["regions"]]
+        elif raw.get("region"):
+            self.regions = [str(raw["region"])]
+        else:
+            self.regions = list(regions)
+        self.region = self.regions[0] if self.regions else None
+        self.image = optional_str(raw, "image")
+        self.dir = optional_str(raw, "dir")
+        self.authenticated = str(raw.get("authenticated", "true")).lower() == "true"
+        self.concurrency = optional_str(raw, "concurrency")
+        self.max_instances = optional_str(raw, "max-instances")
+        self.min_instances = optional_str(raw, "min-instances")
+        self.cpu = optional_str(raw, "cpu")
+        self.cpu_boost = None if raw.get("cpu-boost") is None else str(raw["cpu-boost"]).lower() == "true"
+        self.memory = optional_str(raw, "memory")
+        self.timeout = optional_str(raw, "timeout")
+        self.port = optional_str(raw, "port")
+        self.command = optional_str(raw, "command")
+        self.args = [str(arg) for arg in raw.get("args") or []]
+        self.vpc_connector = optional_str(raw, "vpc-connector")
+        self.env = {str(key): str(value) for key, value in (raw.get("env") or {}).items()}
+        self.labels = {str(key): str(value) for key, value in (raw.get("labels") or {}).items()}
+        self.cloudsql_instances = [str(instance) for instance in raw.get("cloudsql-instances") or []]
+        self.iam_roles = [str(role) for role in raw.get("iam-roles") or []]
+        self.links = [str(link) for link in raw.get("links") or []]
+        self.link_regions = {}
+        self.cron = raw.get("cron")
+        self.rollout = raw.get("rollout")
+        self.warmup = raw.get("warmup")
+        self.build = raw.get("build")
+        self.raw = raw
+
+    @property
+    def primary(self):
+        # Region-wide resources like the Cloud Scheduler job are only set up in the first region
+        return not self.regions or self.region == self.regions[0]
+
+    def in_region(self, region, services):
+        # Copy of this service deployed to one of its regions, links resolve to the same region if possible
+        copy = ServiceConfig.__new__(ServiceConfig)
+        for slot in ServiceConfig.__slots__:
+            setattr(copy, slot, getattr(self, slot))
+        copy.region = region
+        copy.target = target_name(self, region)
+        copy.link_regions = {link: link_region(services.get(link), region) for link in self.links}
+        return copy
+
+    def __repr__(self):
+        return f"ServiceConfig({self.name}: {self.raw})"
+
+
+class MarathonConfig:
+    __slots__ = ("project", "region", "regions", "allow_invoke", "services", "raw", "environment",
+                 "environments")
+
+    def __init__(self, raw, environment=None):
+        if not isinstance(raw, dict):
+            raise ConfigError("run.yaml must be a mapping of first-level values and services")
+        environments = raw.get("environments") or {}
+        if not isinstance(environments, dict):
+            raise ConfigError("'environments' in run.yaml must be a mapping of environment names to overrides")
+
+        self.environment = environment
+        self.environments = [str(name) for name in environments]
+        overrides = {}
+        if environment is not None:
+            if environment not in environments:
+                raise ConfigError(f"Environment {environment} not found in run.yaml")
+            overrides = environments[environment] or {}
+            if not isinstance(overrides, dict):
+                raise ConfigError(f"'environments.{environment}' in run.yaml must be a mapping")
+            raw = merge(raw, overrides)
+        raw = {key: value for key, value in raw.items() if key != "environments"}
+
+        variables = {key: value for key, value in raw.items()
+                     if value is not None and not isinstance(value, (dict, list))}
+        if environment is not None and "environment" not in overrides:
+            variables["environment"] = environment
+        resolver = Resolver(variables)
+        self.raw = resolver.resolve(raw)
+        self.project = optional_str(self.raw, "project")
+        self.regions = [str(region) for region in self.raw.get("regions") or []]
+        self.region = optional_str(self.raw, "region") or (self.regions[0] if self.regions else None)
+        if not self.regions and self.region:
+            self.regions = [self.region]
+        self.allow_invoke = self.raw.get("allow-invoke") or []
+
+        self.services = {}
+        for name, value in self.raw.items():
+            if name not in RESERVED_KEYS and isinstance(value, dict):
+                self.services[name] = ServiceConfig(name, value, self.project, self.regions, environment)
+
+        for service in self.services.values():
+            for link in service.links:
+                service.link_regions[link] = link_region(self.services.get(link), service.region)
+
+        check_links(self.services)
+
+    def __getitem__(self, key):
+        if key in self.services:
+            return self.services[key]
+        return self.raw[key]
+
+    def targets(self, names):
+        # One deploy target per service and region: {target: ServiceConfig}, {target: set(targets)}
+        targets = {}
+        deps_map = {}
+        for name in names:
+            service = self.services[name]
+            if not service.regions:
+                raise ConfigError(f"No region for {name} in run.yaml, set 'region', 'regions' or '{name}.region'")
+            for region in service.regions:
+                target = service.in_region(region, self.services)
+                targets[target.target] = target
+                deps_map[target.target] = {target_name(self.services[link], target.link_regions[link])
+                                           for link in service.links if link in self.services}
+        return targets, deps_map
+
+
+def target_name(service, region):
+    name = service.name if len(service.regions) <= 1 else f"{service.name}@{region}"
+    return f"{service.environment}/{name}" if service.environment else name
+
+
+def merge(base, override):
+    # Mappings are merged recursively, anything else in the override replaces the base value
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def link_region(linked, region):
+    if linked is None or region in linked.regions:
+        return region
+    return linked.region
+
+
+def check_links(services):
+    # Depth-first search instead of toposort, which is only imported by the commands that deploy
+    visited = set()
+
+    def visit(name, path):
+        if name in path:
+            cycle = path[path.index(name):] + [name]
+            raise ConfigError(f"Circular service links in run.yaml: {' -> '.join(cycle)}")
+        if name in visited or name not in services:
+            return
+        for link in services[name].links:
+            visit(link, path + [name])
+        visited.add(name)
+
+    for name in services:
+        visit(name, [])
+
+
+def optional_str(raw, key):
+    value = raw.get(key)
+    return None if value is None else str(value)
@@ -1,16 +1,40 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import time
 import logging
 import subprocess
 import json
 import re
-import http.client as http
 
-from marathon.utils import get_marathon_config, interpolate_var, sanitize_service_name
+from marathon.utils import get_marathon_config, default_region, sanitize_service_name
+from marathon import iam
+from marathon.profiler import span, command_name, GCLOUD
+from marathon.scheduler import run_steps
+from marathon import throttle
+from marathon import rollout, warmup
+import marathon.cached as cached
 
 log = logging.getLogger(__name__)
 
+# gcloud's own error at the end of stderr, which may also contain streamed logs, e.g. of a build
+GCLOUD_ERROR = re.compile(r"^ERROR: (?:\(gcloud[^)]*\)|gcloud crashed)", re.MULTILINE)
+# Quota, rate limit and transient server errors in gcloud's error, worth retrying
+RETRYABLE_ERRORS = re.compile(r"RESOURCE_EXHAUSTED|[Qq]uota exceeded|[Rr]ate limit|\b429\b|UNAVAILABLE"
+                              r"|\b50[0234]\b|INTERNAL|DEADLINE_EXCEEDED|[Cc]onnection reset|timed out")
+RATE_LIMIT_ERRORS = re.compile(r"RESOURCE_EXHAUSTED|[Qq]uota exceeded|[Rr]ate limit|\b429\b")
+# Concurrent IAM policy updates, only worth retrying for commands that read the policy themselves
+CONFLICT_ERRORS = re.compile(r"concurrent policy changes|ABORTED")
+GCLOUD_APIS = {
+    "run": "run",
+    "iam": "iam",
+    "projects": "cloudresourcemanager",
+    "scheduler": "cloudscheduler",
+    "builds": "cloudbuild",
+    "container": "containerregistry",
+}
+
 
 def get_user_email():
     user = None
@@ -22,245 +46,444 @@ def get_user_email():
 
 
 def build(service):
-    conf = get_marathon_config()
-    if "project" not in conf or "dir" not in conf[service] or "image" not in conf[service]:
-        log.error((f"Failed to build {service}: 'project', '{service}.dir' and '{service}.image'"
-                   " are required in run.yaml"))
-        return
+    if not service.project or not service.dir or not service.image:
+        log.error((f"Failed to build {service.name}: 'project', '{service.name}.dir' and"
+                   f" '{service.name}.image' are required in run.yaml"))
+        return False
+
+    # Returns the digest of the pushed image, or True if the build didn't report it
+    digests = build_services([service])
+    if digests is None:
+        return False
+    return digests.get(service.image) or True
+
 
-    dir = interpolate_var(conf[service]["dir"])
-    image = interpolate_var(conf[service]["image"])
-    eval_noout(f"gcloud builds submit --tag={image} {dir} --project={conf['project']}")
+def build_services(services):
+    # One Cloud Build for all services, returns {image: digest} of the pushed images or None if it failed
+    import tempfile
+    from marathon import cloudbuild
 
+    names = ", ".join(service.name for service in services)
+    root = cloudbuild.source_dir(services)
+    with tempfile.NamedTemporaryFile("w", prefix="cloudbuild-", suffix=".yaml", delete=False) as f:
+        f.write(cloudbuild.to_yaml(cloudbuild.config(services, root)))
+    try:
+        returncode, out, err = eval_result(f"gcloud builds submit {root} --config={f.name}"
+                                           f" --project={services[0].project} --format=json", retry=False)
+    finally:
+        os.remove(f.name)
+    if returncode != 0:
+        log.debug(err)
+        log.error(f"Failed to build {names}. Use --verbose for more info")
+        return None
+
+    try:
+        return cloudbuild.image_digests(json.loads(out))
+    except (ValueError, AttributeError):
+        return {}
 
-def deploy(service):
-    conf = get_marathon_config()
-    if "project" not in conf or "region" not in conf or "image" not in conf[service]:
-        log.error(
-            f"Failed to deploy {service}: 'project', 'region' and '{service}.image' are required in run.yaml")
+
+def deploy(service, iam_plan, canary=False):
+    if not service.project or not service.region or not service.image:
+        log.error((f"Failed to deploy {service.name}: 'project', 'region' and '{service.name}.image'"
+                   " are required in run.yaml"))
         return False
 
-    project = conf["project"]
-    region = interpolate_var(conf.get("region", conf["region"]))
-    image = interpolate_var(conf[service]["image"])
+    project, region = service.project, service.region
+    sanitized_service = service.sanitized_name
+    deploy_cmd = {}
+    canary_revision = {}
+
+    def service_account_step():
+        deploy_cmd["service_account"] = setup_service_iam(service)
+        return True
+
+    def deploy_command_step():
+        deploy_cmd["flags"] = complete_deploy_cmd(service)
+        return True
+
+    def traffic_step():
+        # The current split is restored if the canary is rolled back, a new service gets all traffic
+        deploy_cmd["traffic"] = serving_traffic(service)
+        if deploy_cmd["traffic"] is None:
+            log.info(f"[{service.target}]: First deploy, sending all traffic to it")
+        return True
+
+    def deploy_step():
+        log.debug(f"Deploying {service.name} with configuration: {service.raw}")
+        cmd = deploy_command(service, f"--service-account={deploy_cmd['service_account']}{deploy_cmd['flags']}")
+        if deploy_cmd.get("traffic"):
+            cmd += f" --no-traffic --tag={rollout.CANARY_TAG}"
+        log.debug(cmd)
+        # 'run deploy' also updates the invoker policy, a concurrent policy change is safe to retry
+        returncode, _, err = eval_result(cmd, retry_conflicts=True)
+        if returncode != 0:
+            log.debug(err)
+            log.error(f"Failed to deploy {service.target}. Use --verbose for more info")
+            return False
+
+        # gcloud prints the service URL when the deploy finishes, saves a describe call
+        deployed_url = re.search(r"Service URL: (https://\S+)", err)
+        if deployed_url:
+            cached.service_endpoints.set((sanitized_service, project, region), deployed_url.group(1))
+        else:
+            cached.service_endpoints.invalidate((sanitized_service, project, region))
+
+        if deploy_cmd.get("traffic"):
+            revision = re.search(r"revision \[(\S+)\]", err)
+            tag_url = re.search(r"reached directly at (https?://\S+)", err)
+            if revision and tag_url:
+                canary_revision["name"], canary_revision["url"] = revision.group(1), tag_url.group(1)
+            else:
+                canary_revision.update(tagged_revision(service, rollout.CANARY_TAG) or {})
+            if not canary_revision:
+                log.error(f"Failed to find the new revision of {service.target}")
+                return False
+        return True
+
+    def rollout_step():
+        if not deploy_cmd.get("traffic"):
+            return True
+        return rollout.run(service, canary_revision["name"], canary_revision["url"], get_auth_token(),
+                           lambda percent: update_traffic(service, canary_revision["name"], percent),
+                           lambda: restore_traffic(service, deploy_cmd["traffic"]))
+
+    def cron_step():
+        return setup_cron(service)
+
+    def warmup_step():
+        url = get_service_endpoint(sanitized_service, project, region)
+        if url:
+            warmup.run(service, url, get_auth_token())
+        return True
+
+    def iam_step():
+        try:
+            allow_invoke(service, iam_plan)
+        except iam.IamError as e:
+            log.error(f"Failed to set IAM policy of {service.target}: {e}")
+            return False
+        return True
+
+    # Steps without a dependency between them run concurrently
+    steps = {
+        "service account": (service_account_step, set()),
+        "deploy command": (deploy_command_step, set()),
+        "deploy": (deploy_step, {"service account", "deploy command"}),
+        "iam": (iam_step, {"deploy"}),
+    }
+    if canary:
+        steps["traffic"] = (traffic_step, set())
+        steps["deploy"] = (deploy_step, {"service account", "deploy command", "traffic"})
+        # Probes need the invoker bindings of the new revision
+        steps["rollout"] = (rollout_step, {"iam"})
+    if service.warmup:
+        # Runs before this target reports success, so links are warm before their callers are deployed
+        steps["warmup"] = (warmup_step, {"iam", "rollout"} if canary else {"iam"})
+    if service.cron and service.primary:
+        steps["cron"] = (cron_step, {"deploy"})
+    if not run_steps(steps):
+        return False
 
-    service_account = setup_service_iam(service, project, region)
+    deployed_url = get_service_endpoint(sanitized_service, project, region)
+    if deployed_url:
+        log.info(f"[{service.target}]: {deployed_url}")
 
-    log.debug(f"Deploying {service} with configuration: {conf[service]}")
+    return True
 
-    sanitized_service = sanitize_service_name(service)
 
-    deploy_cmd = (f"gcloud beta run deploy {sanitized_service} --image={image} --platform=managed"
-                  f" --region={region} --project={project} --service-account={service_account}")
-    deploy_cmd += complete_deploy_cmd(service, project, region)
+def serving_traffic(service):
+    # {revision: percent} currently serving the service, None if it isn't deployed yet
+    traffic = {}
+    for target in describe_traffic(service) or []:
+        if target.get("percent") and target.get("revisionName"):
+            traffic[target["revisionName"]] = traffic.get(target["revisionName"], 0) + target["percent"]
+    return traffic or None
 
-    log.debug(deploy_cmd)
-    eval_noout(deploy_cmd)
 
-    if "cron" in conf[service]:
-        setup_cron(service, project, region)
+def tagged_revision(service, tag):
+    for target in describe_traffic(service) or []:
+        if target.get("tag") == tag and target.get("url"):
+            return {"name": target["revisionName"], "url": target["url"]}
+    return None
 
-    allow_invoke(service, project, region)
 
-    deployed_url = get_service_endpoint(sanitized_service, project, region)
-    if deployed_url:
-        log.info(f"[{service}]: {deployed_url}")
+def describe_traffic(service):
+    returncode, out, err = eval_result((f"gcloud run services describe {service.sanitized_name}"
+                                        f" --platform=managed --format=json --region={service.region}"
+                                        f" --project={service.project}"))
+    if returncode != 0:
+        log.debug(err)
+        return None
+    return json.loads(out or "{}").get("status", {}).get("traffic", [])
+
 
+def update_traffic(service, revision, percent):
+    # The rest of the traffic stays split proportionally between the revisions serving it,
+    # the last step follows the latest revision again so later deploys get traffic as usual
+    cmd = (f"gcloud run services update-traffic {service.sanitized_name} --platform=managed"
+           f" --region={service.region} --project={service.project}")
+    if percent == 100:
+        cmd += f" --to-latest --remove-tags={rollout.CANARY_TAG}"
+    else:
+        cmd += f" --to-revisions={revision}={percent}"
+    returncode, _, err = eval_result(cmd)
+    if returncode != 0:
+        log.debug(err)
+        return False
     return True
 
 
-def setup_service_iam(service, project, region):
-    conf = get_marathon_config()
-    sanitized_service = sanitize_service_name(service)
-    service_account_name = f"{sanitized_service}-sa"
-    service_account_email = f"{service_account_name}@{project}.iam.gserviceaccount.com"
-
-    if not service_account_exists(service_account_email, project):
-        log.debug(f"Creating service account for {service} ...")
-        eval_stdout(
-            f"gcloud iam service-accounts create {service_account_name} --project={project}")
-
-    if "iam-roles" in conf[service]:
-        for role in conf[service]["iam-roles"]:
-            log.debug(f"Adding {role} to {service} service account ...")
-            eval_noout((f"gcloud projects add-iam-policy-binding {project}"
-                        f" --member=serviceAccount:{service_account_email} --role={role}"
-                        f" --project={project}"))
-
-    if "cloudsql-instances" in conf[service] and len(conf[service]["cloudsql-instances"]) > 0:
-        log.debug(f"Adding CloudSQL Client permission to {service} service account ...")
-        eval_noout((f"gcloud projects add-iam-policy-binding {project}"
-                    f" --member=serviceAccount:{service_account_email} --role=roles/cloudsql.client"
-                    f" --project={project}"))
-
-    if "links" in conf[service]:
-        for linked_service in conf[service]["links"]:
-            log.debug(f"Allowing {service} -> {linked_service} invocation ...")
-            linked_service_sanitized = sanitize_service_name(linked_service)
-            eval_noout((f"gcloud run services add-iam-policy-binding {linked_service_sanitized}"
-                        f" --member=serviceAccount:{service_account_email} --role=roles/run.invoker"
-                        f" --platform=managed --project={project} --region={region}"))
-
-    return service_account_email
-
-
-def complete_deploy_cmd(service, project, region):
-    conf = get_marathon_config()
+def restore_traffic(service, traffic):
+    revisions = ",".join(f"{revision}={percent}" for revision, percent in sorted(traffic.items()))
+    returncode, _, err = eval_result((f"gcloud run services update-traffic {service.sanitized_name}"
+                                      f" --platform=managed --region={service.region}"
+                                      f" --project={service.project} --to-revisions={revisions}"))
+    if returncode != 0:
+        log.debug(err)
+        return False
+    log.info(f"[{service.target}]: Traffic restored to {revisions}")
+    return True
+
+
+def setup_service_iam(service):
+    # Roles and invoker bindings are applied in batches by marathon.iam
+    return ensure_service_account(iam.service_account_name(service.name), service.project)
+
+
+def ensure_service_account(name, project):
+    email = iam.service_account_email(name, project)
+    if not service_account_exists(email, project):
+        log.debug(f"Creating service account {name} ...")
+        returncode, _, err = eval_result(f"gcloud iam service-accounts create {name} --project={project}")
+        if returncode != 0 and "already exists" not in err:
+            raise iam.IamError(f"Failed to create service account {name}: {err.strip()}")
+        cached.service_accounts.set((email, project), True)
+    return email
+
+
+def deploy_config(service, service_account):
+    return f"--service-account={service_account}" + complete_deploy_cmd(service)
+
+
+def deploy_command(service, config):
+    return (f"gcloud beta run deploy {service.sanitized_name} --image={service.image} --platform=managed"
+            f" --region={service.region} --project={service.project} {config}")
+
+
+def get_image_digest(image):
+    if "@sha256:" in image:
+        return image.split("@", 1)[1]
+
+    returncode, out, _ = eval_result(
+        f"gcloud container images describe {image} --format=value(image_summary.digest)")
+    if returncode != 0 or not out.strip():
+        return None
+    return out.strip()
+
+
+def complete_deploy_cmd(service):
     deploy_cmd = ""
 
-    authenticated = True
-    if "authenticated" in conf[service]:
-        authenticated = (interpolate_var(conf[service]["authenticated"]).lower() == 'true')
-    if authenticated:
+    if service.authenticated:
         deploy_cmd += " --no-allow-unauthenticated"
     else:
         deploy_cmd += " --allow-unauthenticated"
 
-    if "concurrency" in conf[service]:
-        deploy_cmd += f" --concurrency={interpolate_var(conf[service]['concurrency'])}"
+    if service.concurrency:
+        deploy_cmd += f" --concurrency={service.concurrency}"
 
-    if "max-instances" in conf[service]:
-        deploy_cmd += f" --max-instances={interpolate_var(conf[service]['max-instances'])}"
+    if service.max_instances:
+        deploy_cmd += f" --max-instances={service.max_instances}"
 
-    if "cpu" in conf[service]:
-        deploy_cmd += f" --cpu={interpolate_var(conf[service]['cpu'])}"
+    if service.min_instances:
+        deploy_cmd += f" --min-instances={service.min_instances}"
 
-    if "memory" in conf[service]:
-        deploy_cmd += f" --memory={interpolate_var(conf[service]['memory'])}"
+    if service.cpu:
+        deploy_cmd += f" --cpu={service.cpu}"
 
-    if "timeout" in conf[service]:
-        deploy_cmd += f" --timeout={interpolate_var(conf[service]['timeout'])}"
+    if service.cpu_boost is not None:
+        deploy_cmd += " --cpu-boost" if service.cpu_boost else " --no-cpu-boost"
 
-    if "port" in conf[service]:
-        deploy_cmd += f" --port={interpolate_var(conf[service]['port'])}"
+    if service.memory:
+        deploy_cmd += f" --memory={service.memory}"
 
-    if "command" in conf[service]:
-        deploy_cmd += f" --command={interpolate_var(conf[service]['command'])}"
+    if service.timeout:
+        deploy_cmd += f" --timeout={service.timeout}"
 
-    if "args" in conf[service] and len(conf[service]["args"]) > 0:
-        args = ""
-        for arg in conf[service]["args"]:
-            args += f"{interpolate_var(arg)},"
-        # Remove trailing comma
-        if args.endswith(","):
-            args = args[:-1]
-        if len(args) > 0:
-            deploy_cmd += f" --args={args}"
+    if service.port:
+        deploy_cmd += f" --port={service.port}"
 
-    if "vpc-connector" in conf[service]:
-        deploy_cmd += f" --vpc-connector={interpolate_var(conf[service]['vpc-connector'])}"
+    if service.command:
+        deploy_cmd += f" --command={service.command}"
 
-    envs = ""
-    if "env" in conf[service] and len(conf[service]["env"]) > 0:
-        for key, value in conf[service]["env"].items():
-            envs += f"{interpolate_var(key)}={interpolate_var(value)},"
-        # Remove trailing comma
-        if envs.endswith(","):
-            envs = envs[:-1]
+    if service.args:
+        deploy_cmd += f" --args={','.join(service.args)}"
 
-    if "links" in conf[service] and len(conf[service]["links"]) > 0:
-        for link in conf[service]["links"]:
-            interpolated_link = interpolate_var(link)
-            url = get_service_endpoint(sanitize_service_name(interpolated_link), project, region)
-            if url:
-                env_link_key = interpolated_link.upper().replace("-", "_") + "_URL"
-                envs += f",{env_link_key}={url}"
-        # Remove starting comma if no previous envs exist
-        if envs.startswith(","):
-            envs = envs[1:]
-
-    if len(envs) > 0:
-        deploy_cmd += f" --set-env-vars={envs}"
-
-    if "labels" in conf[service] and len(conf[service]["labels"]) > 0:
-        labels = ""
-        for key, value in conf[service]["labels"].items():
-            labels += f"{interpolate_var(key)}={interpolate_var(value)},"
-        # Remove trailing comma
-        if labels.endswith(","):
-            labels = labels[:-1]
-        if len(labels) > 0:
-            deploy_cmd += f" --clear-labels --labels={labels}"
-
-    if "cloudsql-instances" in conf[service] and len(conf[service]["cloudsql-instances"]) > 0:
-        cloudsql_instances = ""
-        for instance in conf[service]["cloudsql-instances"]:
-            cloudsql_instances += f"{interpolate_var(instance)},"
-        # Remove trailing comma
-        if cloudsql_instances.endswith(","):
-            cloudsql_instances = cloudsql_instances[:-1]
-        if len(cloudsql_instances) > 0:
-            deploy_cmd += f" --set-cloudsql-instances={cloudsql_instances}"
+    if service.vpc_connector:
+        deploy_cmd += f" --vpc-connector={service.vpc_connector}"
+
+    envs = [f"{key}={value}" for key, value in service.env.items()]
+    for link in service.links:
+        url = get_service_endpoint(sanitize_service_name(link), service.project, service.link_regions[link])
+        if url:
+            envs.append(f"{link.upper().replace('-', '_')}_URL={url}")
+
+    if envs:
+        deploy_cmd += f" --set-env-vars={','.join(envs)}"
+
+    if service.labels:
+        labels = ",".join(f"{key}={value}" for key, value in service.labels.items())
+        deploy_cmd += f" --clear-labels --labels={labels}"
+
+    if service.cloudsql_instances:
+        deploy_cmd += f" --set-cloudsql-instances={','.join(service.cloudsql_instances)}"
 
     return deploy_cmd
 
 
-def setup_cron(service, project, region):
-    conf = get_marathon_config()
-    sanitized_service = sanitize_service_name(service)
-    cron_sa_name = f"run-scheduler-invoker-sa"
-    cron_sa_email = f"{cron_sa_name}@{project}.iam.gserviceaccount.com"
+def setup_cron(service):
+    project = service.project
+    sanitized_service = service.sanitized_name
 
-    cron_config = conf[service]["cron"]
+    cron_config = service.cron
     if "schedule" not in cron_config:
-        log.error(f"No 'schedule' specified in cron config for {service} in run.yaml")
-        return
-
-    if not service_account_exists(cron_sa_email, project):
-        log.debug(f"Creating Cloud Scheduler service account ...")
-        eval_stdout(f"gcloud iam service-accounts create {cron_sa_name} --project={project}")
+        log.error(f"No 'schedule' specified in cron config for {service.name} in run.yaml")
+        return False
 
-    log.debug(f"Allowing Cloud Scheduler -> {service} invocation ...")
-    eval_noout((f"gcloud run services add-iam-policy-binding {sanitized_service}"
-                f" --member=serviceAccount:{cron_sa_email} --role=roles/run.invoker"
-                f" --platform=managed --project={project} --region={region}"))
+    cron_sa_email = ensure_service_account(iam.CRON_SERVICE_ACCOUNT, project)
 
     scheduler_cmd_type = "update"
-    scheduler_list_json, _ = eval_noout(("gcloud scheduler jobs list --format=json"
-                                         f" --project={project} --filter=name:/jobs/{sanitized_service}-job"))
-    scheduler_list = json.loads(scheduler_list_json)
-    if len(scheduler_list) == 0:
+    if not scheduler_job_exists(f"{sanitized_service}-job", project):
         scheduler_cmd_type = "create"
 
-    service_endpoint = get_service_endpoint(sanitized_service, project, region)
+    service_endpoint = get_service_endpoint(sanitized_service, project, service.region)
     if service_endpoint:
         if scheduler_cmd_type == "create":
-            log.info(f"Creating Cloud Scheduler job for {service} ...")
+            log.info(f"Creating Cloud Scheduler job for {service.name} ...")
         cron_cmd = (f"gcloud scheduler jobs {scheduler_cmd_type} http {sanitized_service}-job"
-                    f" --http-method={cron_config.get('http-method', 'post').lower()}"
+                    f" --http-method={str(cron_config.get('http-method', 'post')).lower()}"
                     f" --uri={service_endpoint}{cron_config.get('path', '/')}"
                     f" --oidc-service-account-email={cron_sa_email}"
                     f" --oidc-token-audience={service_endpoint}"
                     f" --project={project}").split(" ")
         cron_cmd.append(f"--schedule={cron_config['schedule']}")
-        eval_stdout(cron_cmd, split=False)
-    else:
-        log.error(f"Failed to create/update Cloud Scheduler job for {service}, no service endpoint")
+        returncode, _, err = eval_result(cron_cmd, split=False)
+        if returncode != 0:
+            log.debug(err)
+            log.error((f"Failed to {scheduler_cmd_type} Cloud Scheduler job for {service.name}."
+                       " Use --verbose for more info"))
+            return False
+        cached.scheduler_jobs.set((f"{sanitized_service}-job", project), True)
+        return True
+
+    log.error(f"Failed to create/update Cloud Scheduler job for {service.name}, no service endpoint")
+    return False
+
+
+def prefetch(project, regions, service_accounts, jobs):
+    # One list call per resource type and region instead of one describe/list call per service
+    def services(region):
+        returncode, out, _ = eval_result((f"gcloud run services list --platform=managed --format=json"
+                                          f" --region={region} --project={project}"))
+        if returncode != 0:
+            return
+        for item in json.loads(out or "[]"):
+            url = item.get("status", {}).get("url")
+            if url:
+                cached.service_endpoints.set((item["metadata"]["name"], project, region), url)
+
+    def accounts():
+        returncode, out, _ = eval_result(f"gcloud iam service-accounts list --format=json --project={project}")
+        if returncode != 0:
+            return
+        existing = {item["email"] for item in json.loads(out or "[]")}
+        for email in existing | set(service_accounts):
+            cached.service_accounts.set((email, project), email in existing)
+
+    def scheduler_jobs():
+        returncode, out, _ = eval_result(f"gcloud scheduler jobs list --format=json --project={project}")
+        if returncode != 0:
+            return
+        existing = {item["name"].rsplit("/", 1)[-1] for item in json.loads(out or "[]")}
+        for job in existing | set(jobs):
+            cached.scheduler_jobs.set((job, project), job in existing)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(regions) + 2) as executor:
+        futures = [executor.submit(services, region) for region in regions] + [executor.submit(accounts)]
+        if jobs:
+            futures.append(executor.submit(scheduler_jobs))
+        for future in futures:
+            try:
+                future.result()
+            except (ValueError, KeyError) as e:
+                log.debug(f"Prefetch failed, falling back to per-service lookups: {e}")
+
+
+def scheduler_job_exists(job, project):
+    def fetch():
+        returncode, out, err = eval_result(("gcloud scheduler jobs list --format=json"
+                                            f" --project={project} --filter=name:/jobs/{job}"))
+        if returncode != 0:
+            log.debug(err)
+            return None
+        return len(json.loads(out or "[]")) > 0
+
+    return cached.scheduler_jobs.get((job, project), fetch)
 
 
 def service_account_exists(service_account_email, project):
-    sa_list_json, _ = eval_noout(("gcloud iam service-accounts list --format=json"
-                                  f" --project={project} --filter=email:{service_account_email}"))
-    sa_list = json.loads(sa_list_json)
-    if len(sa_list) == 0:
-        return False
-    return True
+    def fetch():
+        returncode, out, err = eval_result(("gcloud iam service-accounts list --format=json"
+                                            f" --project={project} --filter=email:{service_account_email}"))
+        if returncode != 0:
+            log.debug(err)
+            return None
+        return len(json.loads(out or "[]")) > 0
 
+    return cached.service_accounts.get((service_account_email, project), fetch)
 
-def allow_invoke(service, project, region):
-    conf = get_marathon_config()
-    sanitized_service = sanitize_service_name(service)
 
-    if "allow-invoke" in conf:
-        for member in conf["allow-invoke"]:
-            if isinstance(member, dict):
-                member = json.dumps(member)
-            # Remove {, }, ", ' and all whitespace characters
-            sanitized_member = re.sub("[{}\"\'\s]", "", member)
-            log.debug(f"Allowing {sanitized_member} -> {service} invocation ...")
-            eval_noout((f"gcloud run services add-iam-policy-binding {sanitized_service}"
-                        f" --member={sanitized_member} --role=roles/run.invoker"
-                        f" --platform=managed --project={project} --region={region}"))
+def allow_invoke(service, iam_plan):
+    _, policies = iam_plan
+    resource = iam.service_resource(service.name, service.project, service.region)
+    if resource in policies:
+        iam.apply(resource, policies[resource], get_iam_policy, set_iam_policy)
+
+
+def get_iam_policy(resource):
+    if resource[0] == "project":
+        cmd = f"gcloud projects get-iam-policy {resource[1]} --format=json"
+    else:
+        _, service, project, region = resource
+        cmd = (f"gcloud run services get-iam-policy {service} --platform=managed"
+               f" --region={region} --project={project} --format=json")
+
+    returncode, out, err = eval_result(cmd)
+    if returncode != 0:
+        raise iam.IamError(err.strip())
+    return json.loads(out)
+
+
+def set_iam_policy(resource, policy):
+    import tempfile
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(policy, f)
+        f.flush()
+        if resource[0] == "project":
+            cmd = f"gcloud projects set-iam-policy {resource[1]} {f.name} --format=json --quiet"
+        else:
+            _, service, project, region = resource
+            cmd = (f"gcloud run services set-iam-policy {service} {f.name} --platform=managed"
+                   f" --region={region} --project={project} --format=json --quiet")
+        returncode, _, err = eval_result(cmd)
+
+    if returncode != 0:
+        # The etag in the policy is stale, someone else updated it since we read it
+        if "etag" in err.lower() or "ABORTED" in err or "409" in err:
+            raise iam.PolicyConflict(err.strip())
+        raise iam.IamError(err.strip())
 
 
 def check():
@@ -272,8 +495,11 @@ def check():
     except Exception:
         log.debug("Could not get project from run.yaml, using gcloud default")
 
-    result_json, _ = eval_noout(cmd)
-    enabled_svc = [svc["config"]["name"] for svc in json.loads(result_json)]
+    returncode, out, err = eval_result(cmd)
+    if returncode != 0:
+        log.error(f"Failed to list enabled services: {err.strip()}")
+        sys.exit(1)
+    enabled_svc = [svc["config"]["name"] for svc in json.loads(out)]
 
     all_enabled = True
     if "run.googleapis.com" not in enabled_svc:
@@ -313,11 +539,13 @@ def list():
 def describe(service, region):
     if not region:
         try:
-            region = get_marathon_config()["region"]
+            region = default_region(service)
         except Exception:
-            log.error(("Specify a region, either in run.yaml or in "
-                       "'run describe <service> --region=<region>'"))
-            sys.exit(1)
+            pass
+    if not region:
+        log.error(("Specify a region, either in run.yaml or in "
+                   "'run describe <service> --region=<region>'"))
+        sys.exit(1)
 
     sanitized_service = sanitize_service_name(service)
     try:
@@ -331,16 +559,49 @@ def describe(service, region):
 
 
 def invoke(args):
-    region = args.region
+    from marathon import load
+
+    service_url, auth_header = invoke_target(args.service, args.region, "invoke")
+    if service_url:
+        if args.repeat > 1 or args.concurrency > 1:
+            log.info(f"Sending {args.repeat} requests to {service_url}{args.path}"
+                     f" over {args.concurrency} connections ...")
+            stats = load.run(service_url, args.request.upper(), args.path, args.data, auth_header,
+                             args.repeat, args.concurrency)
+            if load.log_stats(stats)["errors"]:
+                sys.exit(1)
+            return
+
+        try:
+            conn = load.connect(service_url)
+            out = open(args.output, "wb") if args.output else sys.stdout.buffer
+            try:
+                status, _ = load.send(conn, args.request.upper(), args.path, args.data, auth_header, out)
+            finally:
+                if args.output:
+                    out.close()
+                conn.close()
+        except Exception as e:
+            log.error(e)
+            sys.exit(1)
+        if status >= 400:
+            log.error(f"\n{args.service} responded with HTTP {status}")
+            sys.exit(1)
+
+
+def invoke_target(service, region, command):
+    # Endpoint of a service and the identity token header to call it with, shared by invoke and bench
     if not region:
         try:
-            region = get_marathon_config()["region"]
+            region = default_region(service)
         except Exception:
-            log.error(("Specify a region, either in run.yaml or in "
-                       "'run invoke <service> --region=<region>'"))
-            sys.exit(1)
+            pass
+    if not region:
+        log.error(("Specify a region, either in run.yaml or in "
+                   f"'run {command} <service> --region=<region>'"))
+        sys.exit(1)
 
-    sanitized_service = sanitize_service_name(args.service)
+    sanitized_service = sanitize_service_name(service)
     project = None
     try:
         project = get_marathon_config()["project"]
@@ -353,38 +614,30 @@ def invoke(args):
                    " setup and authorized (https://cloud.google.com/sdk/docs/authorizing)"))
         sys.exit(1)
 
-    service_url = get_service_endpoint(sanitized_service, project, region)
-    if service_url:
-        auth_header = {"Authorization": f"Bearer {token.strip()}"}
-
-        try:
-            conn = http.HTTPSConnection(service_url.replace("https://", ""), 443)
-            conn.request(args.request.upper(), args.path, args.data, auth_header)
-            log.info(conn.getresponse().read().decode())
-            conn.close()
-        except Exception as e:
-            log.error(e)
-            sys.exit(1)
+    return get_service_endpoint(sanitized_service, project, region), {"Authorization": f"Bearer {token.strip()}"}
 
 
 def get_auth_token():
-    token = None
-    try:
-        token, _ = eval_noout("gcloud auth print-identity-token")
-    except Exception:
-        pass
-    return token
+    from marathon import tokens
+    return tokens.get(tokens.IDENTITY)
 
 
 def get_service_endpoint(service, project, region):
+    return cached.service_endpoints.get((service, project, region),
+                                        lambda: describe_service_endpoint(service, project, region))
+
+
+def describe_service_endpoint(service, project, region):
     url = None
+    cmd = f"gcloud run services describe {service} --platform=managed --format=json --region={region}"
     if project:
-        service_json, _ = eval_noout((f"gcloud run services describe {service} --platform=managed"
-                                      f" --format=json --region={region} --project={project}"))
+        cmd += f" --project={project}"
     else:
         log.debug("get_service_endpoint: No project provided, using gcloud default")
-        service_json, _ = eval_noout((f"gcloud run services describe {service} --platform=managed"
-                                      f" --format=json --region={region}"))
+    returncode, service_json, err = eval_result(cmd)
+    if returncode != 0:
+        log.debug(err)
+        return None
     try:
         url = json.loads(service_json)["status"]["address"]["url"]
     except Exception as e:
@@ -398,21 +651,60 @@ def eval_stdout(command, split=True):
     if split:
         command = command.split(" ")
     try:
-        proc = subprocess.Popen(command)
-        proc.communicate()
+        with throttle.slot(api_name(command)), span(command_name(command), GCLOUD):
+            proc = subprocess.Popen(command)
+            proc.communicate()
     except FileNotFoundError:
         gcloud_not_installed()
 
 
 def eval_noout(command, split=True):
+    # stdout is empty if the command failed, so callers never parse a partial or error output
+    returncode, out, err = eval_result(command, split)
+    return (out if returncode == 0 else "", err)
+
+
+def eval_result(command, split=True, retry_conflicts=False, retry=True):
+    # Retries quota, rate limit and transient server errors with backoff, other errors are returned.
+    # retry=False for long-running commands that aren't safe to repeat, like builds
     if split:
         command = command.split(" ")
-    try:
-        pipe = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = pipe.communicate()
-        return (out.decode(), err.decode())
-    except FileNotFoundError:
-        gcloud_not_installed()
+    api = api_name(command)
+    for attempt in range(throttle.RETRIES + 1 if retry else 1):
+        try:
+            with throttle.slot(api), span(command_name(command), GCLOUD):
+                pipe = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = pipe.communicate()
+        except FileNotFoundError:
+            gcloud_not_installed()
+        out, err = out.decode(), err.decode()
+
+        if pipe.returncode == 0:
+            throttle.succeeded(api)
+            break
+        error = gcloud_error(err)
+        retryable = RETRYABLE_ERRORS.search(error) or (retry_conflicts and CONFLICT_ERRORS.search(error))
+        if not retry or attempt == throttle.RETRIES or not retryable:
+            break
+        if RATE_LIMIT_ERRORS.search(error):
+            throttle.rate_limited(api)
+        delay = throttle.backoff(attempt)
+        log.debug(f"'{command_name(command)}' failed, retrying in {delay:.1f}s: {error.strip()}")
+        time.sleep(delay)
+
+    return (pipe.returncode, out, err)
+
+
+def gcloud_error(err):
+    # The last 'ERROR: (gcloud.…)' of stderr and anything after it, empty if there is none
+    starts = [match.start() for match in GCLOUD_ERROR.finditer(err)]
+    return err[starts[-1]:] if starts else ""
+
+
+def api_name(command):
+    # The Google API a gcloud command talks to, for per-API rate limits
+    words = [word for word in command[1:3] if not word.startswith("-") and word not in ("alpha", "beta")]
+    return GCLOUD_APIS.get(words[0]) if words else None
 
 
 def gcloud_not_installed():
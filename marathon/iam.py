@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import time
+import logging
+
+from marathon.utils import get_marathon_config, sanitize_service_name
+from marathon import throttle
+
+log = logging.getLogger(__name__)
+
+CRON_SERVICE_ACCOUNT = "run-scheduler-invoker-sa"
+INVOKER_ROLE = "roles/run.invoker"
+
+
+class IamError(Exception):
+    pass
+
+
+class PolicyConflict(IamError):
+    pass
+
+
+def service_account_name(service):
+    return f"{sanitize_service_name(service)}-sa"
+
+
+def service_account_email(name, project):
+    return f"{name}@{project}.iam.gserviceaccount.com"
+
+
+def project_resource(project):
+    return ("project", project)
+
+
+def service_resource(service, project, region):
+    return ("service", sanitize_service_name(service), project, region)
+
+
+def allow_invoke_members(conf=None):
+    members = []
+    for member in (conf or get_marathon_config()).allow_invoke:
+        if isinstance(member, dict):
+            member = json.dumps(member)
+        # Remove {, }, ", ' and all whitespace characters
+        members.append(re.sub("[{}\"\'\s]", "", member))
+    return members
+
+
+def plan(targets, conf=None):
+    # Collect every binding the given deploy targets need: {resource: {role: set(members)}}
+    # Service accounts are per project, so a service deployed to several regions shares one
+    conf = conf or get_marathon_config()
+    project = conf.project
+    service_accounts = set()
+    policies = {}
+
+    def bind(resource, role, member):
+        policies.setdefault(resource, {}).setdefault(role, set()).add(member)
+
+    invokers = allow_invoke_members(conf)
+    for service in targets:
+        sa_name = service_account_name(service.name)
+        member = f"serviceAccount:{service_account_email(sa_name, project)}"
+        service_accounts.add(sa_name)
+
+        for role in service.iam_roles:
+            bind(project_resource(project), role, member)
+
+        if service.cloudsql_instances:
+            bind(project_resource(project), "roles/cloudsql.client", member)
+
+        for link in service.links:
+            bind(service_resource(link, project, service.link_regions[link]), INVOKER_ROLE, member)
+
+        resource = service_resource(service.name, project, service.region)
+        if service.cron and service.primary:
+            service_accounts.add(CRON_SERVICE_ACCOUNT)
+            cron_member = f"serviceAccount:{service_account_email(CRON_SERVICE_ACCOUNT, project)}"
+            bind(resource, INVOKER_ROLE, cron_member)
+
+        for invoker in invokers:
+            bind(resource, INVOKER_ROLE, invoker)
+
+    return sorted(service_accounts), policies
+
+
+def prepare(backend, service_accounts, policies, targets, jobs, project=None):
+    # Service accounts and the policies of resources that are not being deployed are set up
+    # before any deploy, the policy of a deployed service is applied right after its deploy
+    project = project or get_marathon_config().project
+    deployed = {service_resource(service.name, project, service.region) for service in targets}
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        list(executor.map(lambda name: backend.ensure_service_account(name, project), service_accounts))
+        list(executor.map(
+            lambda resource: apply(resource, policies[resource], backend.get_iam_policy,
+                                   backend.set_iam_policy),
+            [resource for resource in policies if resource not in deployed]))
+
+
+def apply(resource, role_members, get_policy, set_policy, remove=None, retries=5):
+    for attempt in range(retries):
+        policy = get_policy(resource)
+        changed = add_bindings(policy, role_members)
+        if remove:
+            changed = remove_bindings(policy, remove) or changed
+        if not changed:
+            log.debug(f"IAM policy of {resource} is up to date")
+            return
+
+        log.debug(f"Updating IAM policy of {resource} ...")
+        try:
+            set_policy(resource, policy)
+            return
+        except PolicyConflict:
+            if attempt == retries - 1:
+                raise
+            log.debug(f"IAM policy of {resource} changed concurrently, retrying ...")
+            time.sleep(throttle.backoff(attempt))
+
+
+def add_bindings(policy, role_members):
+    changed = False
+    bindings = policy.setdefault("bindings", [])
+    for role, members in role_members.items():
+        binding = next((b for b in bindings if b["role"] == role and "condition" not in b), None)
+        if binding is None:
+            binding = {"role": role, "members": []}
+            bindings.append(binding)
+        for member in sorted(members):
+            if member not in binding["members"]:
+                binding["members"].append(member)
+                changed = True
+    policy["bindings"] = [b for b in bindings if b["members"]]
+    return changed
+
+
+def remove_bindings(policy, role_members):
+    changed = False
+    for binding in policy.get("bindings", []):
+        members = role_members.get(binding["role"], ())
+        kept = [member for member in binding["members"] if member not in members]
+        changed = changed or len(kept) != len(binding["members"])
+        binding["members"] = kept
+    policy["bindings"] = [b for b in policy.get("bindings", []) if b["members"]]
+    return changed
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import time
+import logging
+import threading
+import http.client as http
+
+from urllib.parse import urlsplit
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 300
+
+
+def connect(url):
+    parts = urlsplit(url)
+    if parts.scheme == "http":
+        return http.HTTPConnection(parts.netloc, timeout=TIMEOUT)
+    return http.HTTPSConnection(parts.netloc, timeout=TIMEOUT)
+
+
+def open_body(data):
+    # '@file' is streamed from disk in chunks instead of being read into memory
+    if data.startswith("@"):
+        path = data[1:]
+        return open(path, "rb"), os.path.getsize(path)
+    body = data.encode()
+    return body, len(body)
+
+
+def send(conn, method, path, data, headers, out=None):
+    # Returns (status, bytes received), the response is streamed to out or read and dropped
+    # so the keep-alive connection can be reused
+    body, length = open_body(data)
+    if length:
+        headers = {**headers, "Content-Length": str(length)}
+    try:
+        # Files are sent as an iterable of chunks, http.client's own blocksize is only settable on 3.7+
+        chunks = iter(lambda: body.read(CHUNK_SIZE), b"") if hasattr(body, "read") else body
+        conn.request(method, path, chunks if length else None, headers)
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+    response = conn.getresponse()
+    received = 0
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        received += len(chunk)
+        if out:
+            out.write(chunk)
+    if out:
+        out.flush()
+    return response.status, received
+
+
+def run(url, method, path, data, headers, repeat, concurrency, duration=None, rate=None):
+    # Closed loop by default: each worker sends its next request as soon as the previous one finished.
+    # With a rate, requests are scheduled at fixed intervals (open loop) and their latency counts from
+    # the scheduled time, so queueing behind a slow server isn't hidden. Each worker keeps its own
+    # connection alive, a failed connection is reopened on the next request
+    lock = threading.Lock()
+    sent = [0]
+    # last_sent: when the last request actually went out, behind its schedule if no connection was free
+    stats = {"latencies": [], "starts": [], "statuses": {}, "errors": {}, "received": 0, "last_sent": 0.0}
+    start = time.perf_counter()
+
+    def next_request():
+        with lock:
+            if repeat is not None and sent[0] >= repeat:
+                return None
+            scheduled = start + sent[0] / rate if rate else time.perf_counter()
+            if duration is not None and scheduled - start >= duration:
+                return None
+            sent[0] += 1
+            return scheduled
+
+    def worker():
+        conn = None
+        while True:
+            scheduled = next_request()
+            if scheduled is None:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sent_at = time.perf_counter() - start
+            with lock:
+                stats["last_sent"] = max(stats["last_sent"], sent_at)
+
+            try:
+                conn = conn or connect(url)
+                status, received = send(conn, method, path, data, headers)
+            except (OSError, http.HTTPException) as e:
+                if conn:
+                    conn.close()
+                    conn = None
+                with lock:
+                    error = type(e).__name__
+                    stats["errors"][error] = stats["errors"].get(error, 0) + 1
+                continue
+            latency = time.perf_counter() - scheduled
+
+            with lock:
+                stats["latencies"].append(latency)
+                stats["starts"].append(scheduled - start)
+                stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+                stats["received"] += received
+        if conn:
+            conn.close()
+
+    workers = concurrency if repeat is None else min(concurrency, repeat)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def merge(results):
+    # Stats of several processes running at the same time
+    stats = {"latencies": [], "starts": [], "statuses": {}, "errors": {}, "received": 0, "seconds": 0.0,
+             "last_sent": 0.0}
+    for result in results:
+        stats["latencies"] += result["latencies"]
+        stats["starts"] += result["starts"]
+        for key in ("statuses", "errors"):
+            for name, count in result[key].items():
+                stats[key][name] = stats[key].get(name, 0) + count
+        stats["received"] += result["received"]
+        stats["seconds"] = max(stats["seconds"], result["seconds"])
+        stats["last_sent"] = max(stats["last_sent"], result["last_sent"])
+    return stats
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values), math.ceil(p / 100 * len(values))) - 1)]
+
+
+def summary(stats):
+    latencies = sorted(stats["latencies"])
+    seconds = stats["seconds"] or 1e-9
+    return {
+        "requests": len(latencies) + sum(stats["errors"].values()),
+        "errors": sum(stats["errors"].values()) + sum(
+            count for status, count in stats["statuses"].items() if status >= 400),
+        "throughput": len(latencies) / seconds,
+        "received_mb_per_second": stats["received"] / seconds / 1024 / 1024,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "p999": percentile(latencies, 99.9),
+        "max": latencies[-1] if latencies else 0.0,
+    }
+
+
+def log_stats(stats):
+    result = summary(stats)
+    statuses = ", ".join(f"{status} x{count}" for status, count in sorted(stats["statuses"].items()))
+    errors = ", ".join(f"{error} x{count}" for error, count in sorted(stats["errors"].items()))
+
+    log.info(f"Requests:    {result['requests']} in {stats['seconds']:.2f}s, {result['errors']} failed")
+    log.info(f"Status:      {statuses or '-'}" + (f", {errors}" if errors else ""))
+    log.info(f"Throughput:  {result['throughput']:.1f} req/s, {result['received_mb_per_second']:.2f} MB/s")
+    log.info((f"Latency:     p50 {result['p50'] * 1000:.1f}ms  p95 {result['p95'] * 1000:.1f}ms"
+              f"  p99 {result['p99'] * 1000:.1f}ms  max {result['max'] * 1000:.1f}ms"))
+    return result
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import logging
+
+from marathon import cloudbuild, iam, state
+from marathon.config import escape
+import marathon.cached as cached
+
+log = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+DEPLOY = "deploy"
+SKIP = "skip"
+# Used until a build, deploy or IAM setup has been timed once in this project
+DEFAULT_ESTIMATES = {"build": 120.0, "deploy": 60.0, "iam": 10.0}
+
+
+def create(conf, backend_name, service, targets, deps_map, iam_plan, builds, digests, backend,
+           force=False, canary=False):
+    # Everything 'run apply' needs to deploy exactly this, without run.yaml or any lookups:
+    # the resolved config, pinned image digests, the IAM plan and the lookups made while planning
+    plan = {
+        "version": PLAN_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "backend": backend_name,
+        "service": service,
+        "canary": canary,
+        "config": escape(conf.raw),
+        "service_accounts": iam_plan[0],
+        "bindings": [[list(resource), role, sorted(members)]
+                     for resource, role_members in sorted(iam_plan[1].items())
+                     for role, members in sorted(role_members.items())],
+        "lookups": {
+            "endpoints": sorted([*key, url] for key, url in cached.service_endpoints.items()),
+            "service_accounts": sorted([*key, exists] for key, exists in cached.service_accounts.items()),
+            "scheduler_jobs": sorted([*key, exists] for key, exists in cached.scheduler_jobs.items()),
+        },
+        "builds": {},
+        "targets": {},
+    }
+
+    for name, fingerprint in sorted(builds.items()):
+        service_conf = conf.services[name]
+        plan["builds"][name] = {
+            "image": service_conf.image,
+            "fingerprint": fingerprint,
+            "config": cloudbuild.config([service_conf]),
+            "command": (f"gcloud builds submit {service_conf.dir} --config=cloudbuild.yaml"
+                        f" --project={service_conf.project}"),
+            "estimate": estimate("build", service_conf.image),
+        }
+
+    for target, target_conf in sorted(targets.items()):
+        key = state.service_key(target_conf.name, target_conf.project, target_conf.region)
+        entry = {
+            "service": target_conf.name,
+            "region": target_conf.region,
+            "deps": sorted(deps_map[target]),
+            "build": target_conf.name if target_conf.name in builds else None,
+            "image": target_conf.image,
+            "fingerprint": None,
+            "cron": bool(target_conf.cron and target_conf.primary),
+            "estimate": estimate("deploy", key),
+        }
+        # Fingerprinted with the image pinned to its digest, like deploy_service does
+        pinned = target_conf.in_region(target_conf.region, conf.services)
+        digest = digests.get(target_conf.image) if not entry["build"] else None
+        if digest:
+            from marathon.utils import pin_image
+            pinned.image = entry["image"] = pin_image(target_conf.image, digest)
+            entry["fingerprint"] = state.deploy_fingerprint(backend, pinned, iam_plan, digest)
+
+        if entry["build"]:
+            entry["action"], entry["reason"] = DEPLOY, "image is rebuilt first"
+        elif not entry["fingerprint"]:
+            entry["action"], entry["reason"] = DEPLOY, "image digest unknown"
+        elif force:
+            entry["action"], entry["reason"] = DEPLOY, "forced"
+        elif state.read("deploys", key) == entry["fingerprint"]:
+            entry["action"], entry["reason"] = SKIP, "image and configuration unchanged"
+        elif state.read("deploys", key) is None:
+            entry["action"], entry["reason"] = DEPLOY, "not deployed from here before"
+        else:
+            entry["action"], entry["reason"] = DEPLOY, "image or configuration changed"
+
+        sa = iam.service_account_email(iam.service_account_name(target_conf.name), target_conf.project)
+        entry["config"] = backend.deploy_config(pinned, sa)
+        if backend_name == "gcloud":
+            entry["command"] = backend.deploy_command(pinned, entry["config"])
+        plan["targets"][target] = entry
+
+    node_deps, estimates = graph(plan)
+    plan["waves"] = waves(node_deps)
+    seconds, path = critical_path(estimates, node_deps)
+    plan["critical_path"] = {"seconds": seconds, "nodes": path}
+    plan["iam_estimate"] = estimate("iam", conf.project)
+    return plan
+
+
+def graph(plan):
+    # Build and deploy nodes of the plan, a target depends on the build of its image
+    node_deps = {}
+    estimates = {}
+    for name, build in plan["builds"].items():
+        node_deps[build_node(name)] = set()
+        estimates[build_node(name)] = build["estimate"]
+    for target, entry in plan["targets"].items():
+        node_deps[target] = set(entry["deps"])
+        if entry["build"]:
+            node_deps[target].add(build_node(entry["build"]))
+        estimates[target] = entry["estimate"] if entry["action"] == DEPLOY else 0.0
+    return node_deps, estimates
+
+
+def build_node(service):
+    return f"build:{service}"
+
+
+def waves(deps_map):
+    from toposort import toposort
+    return [sorted(node for node in level if node in deps_map) for level in toposort(deps_map)]
+
+
+def critical_path(estimates, deps_map):
+    # Longest chain of estimated durations through the dependency graph
+    finish = {}
+    previous = {}
+    for level in waves(deps_map):
+        for node in level:
+            deps = [dep for dep in deps_map[node] if dep in finish]
+            dep = max(deps, key=lambda d: finish[d], default=None)
+            finish[node] = estimates[node] + (finish[dep] if dep else 0.0)
+            previous[node] = dep
+    if not finish:
+        return 0.0, []
+
+    node = max(sorted(finish), key=lambda n: finish[n])
+    seconds = finish[node]
+    path = []
+    while node:
+        path.append(node)
+        node = previous[node]
+    return seconds, path[::-1]
+
+
+def estimate(kind, key):
+    # The last measured duration, or the median of the same kind of operation
+    durations = state.read_section("durations")
+    if f"{kind}/{key}" in durations:
+        return durations[f"{kind}/{key}"]
+    known = sorted(value for name, value in durations.items() if name.startswith(f"{kind}/"))
+    return known[len(known) // 2] if known else DEFAULT_ESTIMATES[kind]
+
+
+def iam_plan(plan):
+    policies = {}
+    for resource, role, members in plan["bindings"]:
+        policies.setdefault(tuple(resource), {}).setdefault(role, set()).update(members)
+    return plan["service_accounts"], policies
+
+
+def seed_lookups(plan):
+    for service, project, region, url in plan["lookups"]["endpoints"]:
+        cached.service_endpoints.set((service, project, region), url)
+    for email, project, exists in plan["lookups"]["service_accounts"]:
+        cached.service_accounts.set((email, project), exists)
+    for job, project, exists in plan["lookups"]["scheduler_jobs"]:
+        cached.scheduler_jobs.set((job, project), exists)
+
+
+def write(plan, path):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+
+
+def read(path):
+    with open(path, "r") as f:
+        plan = json.load(f)
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"{path} is not a plan of this marathon version, create it again with 'run plan'")
+    return plan
+
+
+def log_plan(plan, jobs):
+    conf = plan["config"]
+    log.info(f"Plan for {conf.get('project')} ({plan['backend']} backend, created {plan['created']}):")
+
+    if plan["builds"]:
+        log.info("\nBuilds:")
+        for name, build in sorted(plan["builds"].items()):
+            log.info(f"  {name:<24} ~{build['estimate']:.0f}s  {build['command']}")
+
+    if plan["service_accounts"]:
+        log.info("\nService accounts:")
+        for name in plan["service_accounts"]:
+            log.info(f"  {name}")
+
+    if plan["bindings"]:
+        log.info("\nIAM bindings:")
+        for resource, role, members in plan["bindings"]:
+            log.info(f"  {' '.join(resource[:2])}{f' ({resource[3]})' if len(resource) > 3 else ''}"
+                     f"  {role}: {', '.join(members)}")
+
+    log.info("\nDeploys:")
+    for number, wave in enumerate(plan["waves"], 1):
+        log.info(f"  Wave {number}:")
+        for node in wave:
+            if node not in plan["targets"]:
+                log.info(f"    {node}")
+                continue
+            entry = plan["targets"][node]
+            label = f"~{entry['estimate']:.0f}s" if entry["action"] == DEPLOY else ""
+            log.info(f"    {node:<24} {entry['action']:<7} {label:>6}  {entry['reason']}"
+                     + (", then cron job" if entry["cron"] and entry["action"] == DEPLOY else ""))
+            if entry["action"] == DEPLOY:
+                log.info(f"      {entry.get('command') or entry['config']}")
+
+    deploys = [node for node, entry in plan["targets"].items() if entry["action"] == DEPLOY]
+    critical = plan["critical_path"]
+    total = sum(build["estimate"] for build in plan["builds"].values()) + sum(
+        plan["targets"][node]["estimate"] for node in deploys)
+    # Waves only overlap as far as the number of jobs allows
+    duration = plan["iam_estimate"] + max(critical["seconds"], total / max(1, jobs))
+    log.info(f"\n{len(plan['builds'])} builds, {len(deploys)} deploys,"
+             f" {len(plan['targets']) - len(deploys)} skipped")
+    if critical["seconds"]:
+        log.info(f"Critical path: {' -> '.join(critical['nodes'])} ~{critical['seconds']:.0f}s")
+    log.info(f"Estimated duration with {jobs} jobs: ~{duration:.0f}s, including ~{plan['iam_estimate']:.0f}s"
+             " of IAM setup")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+STEP = "step"
+GCLOUD = "gcloud"
+HTTP = "http"
+
+_lock = threading.Lock()
+_spans = []
+_context = threading.local()
+_start = time.perf_counter()
+
+
+def current_service():
+    return getattr(_context, "service", None)
+
+
+@contextmanager
+def service_context(service):
+    previous = current_service()
+    _context.service = service
+    try:
+        yield
+    finally:
+        _context.service = previous
+
+
+@contextmanager
+def span(name, category=STEP):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with _lock:
+            _spans.append((name, category, current_service(), start, end, threading.get_ident()))
+
+
+def command_name(command):
+    words = []
+    for word in command[:5]:
+        if word.startswith("-") or "/" in word or "@" in word:
+            break
+        words.append(word)
+    return " ".join(words[:4])
+
+
+def log_report():
+    with _lock:
+        spans = list(_spans)
+    if not spans:
+        return
+
+    services = {}
+    for name, category, service, start, end, _ in spans:
+        steps = services.setdefault(service or "-", {})
+        step = steps.setdefault((category, name), [0, 0.0])
+        step[0] += 1
+        step[1] += end - start
+
+    log.info("\nProfile:")
+    for service in sorted(services, key=lambda s: (s == "-", s)):
+        steps = services[service]
+        processes = sum(count for (category, _), (count, _) in steps.items() if category == GCLOUD)
+        requests = sum(count for (category, _), (count, _) in steps.items() if category == HTTP)
+        log.info(f"  {service}  ({processes} gcloud processes, {requests} API requests)")
+        for (category, name), (count, duration) in sorted(steps.items(), key=lambda s: -s[1][1]):
+            label = f"{category}: {name}" if category == HTTP else name
+            log.info(f"    {label:<48} {duration:7.2f}s  x{count}")
+
+    processes = [s for s in spans if s[1] == GCLOUD]
+    log.info(f"\n  Total: {len(processes)} gcloud processes,"
+             f" {sum(s[4] - s[3] for s in processes):.2f}s spent in gcloud")
+
+
+def write_trace(path):
+    # Chrome trace event format, load with chrome://tracing or https://ui.perfetto.dev
+    with _lock:
+        spans = list(_spans)
+
+    events = []
+    for name, category, service, start, end, thread in spans:
+        events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - _start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": thread,
+            "args": {"service": service},
+        })
+
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    log.info(f"Trace written to {path}")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import logging
+import subprocess
+
+from marathon.config import ConfigError
+
+log = logging.getLogger(__name__)
+
+CANARY_TAG = "canary"
+DEFAULTS = {
+    "steps": [5, 25, 50, 100],
+    "interval": 30,
+    "path": "/",
+    "method": "GET",
+    "requests": 20,
+    "concurrency": 2,
+    "max-latency": None,
+    "max-error-rate": 0.01,
+    "probe": None,
+}
+
+
+def settings(service):
+    # The service's 'rollout' block on top of the defaults, services without one use the defaults
+    rollout = service.rollout or {}
+    if not isinstance(rollout, dict):
+        raise ConfigError(f"'{service.name}.rollout' in run.yaml must be a mapping")
+    unknown = sorted(set(rollout) - set(DEFAULTS))
+    if unknown:
+        raise ConfigError(f"Unknown keys in '{service.name}.rollout' in run.yaml: {', '.join(unknown)}")
+
+    conf = {**DEFAULTS, **rollout}
+    try:
+        conf["steps"] = [int(step) for step in conf["steps"]]
+        conf["interval"] = float(conf["interval"])
+        conf["requests"] = int(conf["requests"])
+        conf["concurrency"] = int(conf["concurrency"])
+        conf["max-error-rate"] = float(conf["max-error-rate"])
+        if conf["max-latency"] is not None:
+            conf["max-latency"] = float(conf["max-latency"])
+    except (TypeError, ValueError) as e:
+        raise ConfigError(f"Invalid '{service.name}.rollout' in run.yaml: {e}")
+
+    steps = conf["steps"]
+    if not steps or steps[-1] != 100 or steps != sorted(set(steps)) or steps[0] <= 0:
+        raise ConfigError(f"'{service.name}.rollout.steps' in run.yaml must be increasing percentages"
+                          " ending with 100")
+    conf["method"] = str(conf["method"]).upper()
+    conf["path"] = str(conf["path"])
+    return conf
+
+
+def run(service, revision, url, token, shift, rollback):
+    # Probes the new revision through its tag URL before it gets any traffic and after every step,
+    # shift(percent) and rollback() update the traffic split of the service
+    conf = settings(service)
+    problem = probe(service, conf, url, token)
+    for percent in conf["steps"]:
+        if problem:
+            log.error(f"[{service.target}]: Rolling back {revision}, {problem}")
+            if not rollback():
+                log.error(f"[{service.target}]: Failed to roll back {revision}. Use --verbose for more info")
+            return False
+
+        log.info(f"[{service.target}]: Sending {percent}% of traffic to {revision} ...")
+        if not shift(percent):
+            log.error(f"[{service.target}]: Failed to shift traffic to {revision}. Use --verbose for more info")
+            rollback()
+            return False
+        if percent == 100:
+            return True
+
+        time.sleep(conf["interval"])
+        problem = probe(service, conf, url, token)
+    return True
+
+
+def probe(service, conf, url, token):
+    # Returns why the revision is unhealthy, None if it's within the thresholds
+    if conf["probe"]:
+        env = {**os.environ, "MARATHON_CANARY_URL": url, "MARATHON_TOKEN": token or ""}
+        returncode = subprocess.run(str(conf["probe"]), shell=True, env=env).returncode
+        if returncode != 0:
+            return f"probe '{conf['probe']}' exited with {returncode}"
+
+    if conf["requests"] <= 0:
+        return None
+
+    from marathon import load
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    stats = load.run(url, conf["method"], conf["path"], "", headers, conf["requests"], conf["concurrency"])
+    # Client errors are the caller's fault, only server and connection errors count against the revision
+    errors = sum(stats["errors"].values()) + sum(
+        count for status, count in stats["statuses"].items() if status >= 500)
+    error_rate = errors / conf["requests"]
+    p95 = load.summary(stats)["p95"] * 1000
+    log.info(f"[{service.target}]: Canary p95 {p95:.1f}ms, {error_rate:.1%} errors")
+
+    if error_rate > conf["max-error-rate"]:
+        return f"error rate {error_rate:.1%} above {conf['max-error-rate']:.1%}"
+    if conf["max-latency"] is not None and p95 > conf["max-latency"]:
+        return f"p95 latency {p95:.1f}ms above {conf['max-latency']:.0f}ms"
+    return None
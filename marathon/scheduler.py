@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import logging
+
+from marathon import profiler
+
+log = logging.getLogger(__name__)
+
+OK = "ok"
+SKIPPED = "skipped"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Rough resident memory of one gcloud process, used to size the default worker pool
+GCLOUD_PROCESS_MEMORY = 256 * 1024 * 1024
+MAX_DEFAULT_JOBS = 32
+
+
+def default_jobs():
+    # gcloud jobs mostly wait on the network, so memory is the real limit on CI runners
+    cpu_jobs = (os.cpu_count() or 1) * 4
+    memory_jobs = available_memory() // GCLOUD_PROCESS_MEMORY
+    return max(1, min(cpu_jobs, memory_jobs or cpu_jobs, MAX_DEFAULT_JOBS))
+
+
+def available_memory():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def run_dag(deps_map, fn, jobs, log_cancelled=True):
+    # deps_map: {node: set(nodes it depends on)}, deps outside deps_map are treated as satisfied
+    # Raises toposort.CircularDependencyError before anything is started
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    from toposort import toposort
+
+    levels = [[node for node in sorted(level) if node in deps_map] for level in toposort(deps_map)]
+    order = [node for level in levels for node in level]
+    deps = {node: set(deps_map[node]) & set(deps_map) for node in deps_map}
+
+    dependants = {node: set() for node in deps}
+    for node, node_deps in deps.items():
+        for dep in node_deps:
+            dependants[dep].add(node)
+
+    results = {}
+    timings = {}
+    service = profiler.current_service()
+
+    def timed(node):
+        start = time.monotonic()
+        try:
+            with profiler.service_context(service):
+                return fn(node)
+        finally:
+            timings[node] = time.monotonic() - start
+
+    def cancel_dependants(node):
+        for dependant in dependants[node]:
+            if dependant not in results:
+                results[dependant] = CANCELLED
+                timings[dependant] = 0.0
+                if log_cancelled:
+                    log.error(f"Cancelling {dependant}: depends on {node} which did not finish")
+                cancel_dependants(dependant)
+
+    pending = list(order)
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        while pending or running:
+            succeeded = {n for n, status in results.items() if status in (OK, SKIPPED)}
+            for node in [n for n in pending if deps[n] <= succeeded]:
+                pending.remove(node)
+                running[executor.submit(timed, node)] = node
+            pending = [n for n in pending if n not in results]
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    success = future.result()
+                except Exception as e:
+                    log.error(f"{node}: {e}")
+                    success = False
+
+                if not success:
+                    results[node] = FAILED
+                    cancel_dependants(node)
+                else:
+                    results[node] = SKIPPED if success == SKIPPED else OK
+    except KeyboardInterrupt:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+
+    return {node: (results.get(node, CANCELLED), timings.get(node, 0.0)) for node in order}
+
+
+def run_steps(steps):
+    # steps: {name: (fn, set(names it depends on))}, independent steps run concurrently
+    def run_step(name):
+        with profiler.span(name):
+            return steps[name][0]()
+
+    results = run_dag({name: deps for name, (_, deps) in steps.items()}, run_step, len(steps),
+                      log_cancelled=False)
+    return all(status == OK for status, _ in results.values())
+
+
+def log_summary(results, title):
+    if not results:
+        return
+
+    width = max(len(node) for node in results)
+    log.info(f"\n{title}:")
+    for node, (status, duration) in sorted(results.items(), key=lambda r: -r[1][1]):
+        log.info(f"  {node:<{width}}  {status:<9}  {duration:6.1f}s")
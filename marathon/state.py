@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import re
+import fnmatch
+import hashlib
+import functools
+import posixpath
+import logging
+import threading
+
+from marathon import iam
+
+log = logging.getLogger(__name__)
+
+STATE_FILE = os.path.join(".marathon", "state.json")
+ALWAYS_IGNORED = [".git", ".marathon"]
+
+_lock = threading.Lock()
+_state = {}
+
+
+def load():
+    if not _state and os.path.exists(STATE_FILE):
+        try:
+            with open(STATE_FILE, "r") as f:
+                _state.update(json.load(f))
+        except (OSError, ValueError) as e:
+            log.debug(f"Ignoring unreadable {STATE_FILE}: {e}")
+    return _state
+
+
+def read(section, key):
+    with _lock:
+        return load().get(section, {}).get(key)
+
+
+def read_section(section):
+    with _lock:
+        return dict(load().get(section, {}))
+
+
+def write(section, key, value):
+    with _lock:
+        load().setdefault(section, {})[key] = value
+        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        # Write to a temporary file first so an interrupted run can't leave a truncated state file
+        with open(f"{STATE_FILE}.tmp", "w") as f:
+            json.dump(_state, f, indent=2, sort_keys=True)
+        os.replace(f"{STATE_FILE}.tmp", STATE_FILE)
+
+
+def service_key(service, project, region):
+    return f"{project}/{region}/{service}"
+
+
+def deploy_fingerprint(backend, service, iam_plan, digest=None):
+    project = service.project
+    digest = digest or backend.get_image_digest(service.image)
+    if not digest:
+        log.debug(f"Could not resolve image digest of {service.name}, it will always be deployed")
+        return None
+
+    service_account = iam.service_account_email(iam.service_account_name(service.name), project)
+    member = f"serviceAccount:{service_account}"
+    own_resource = iam.service_resource(service.name, project, service.region)
+    _, policies = iam_plan
+    bindings = []
+    for resource, role_members in policies.items():
+        for role, members in role_members.items():
+            for m in members:
+                if resource == own_resource or m == member:
+                    bindings.append([list(resource), role, m])
+
+    inputs = {
+        "digest": digest,
+        "deploy": backend.deploy_config(service, service_account),
+        "iam": sorted(bindings),
+        "cron": service.cron if service.primary else None,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def source_fingerprint(dir):
+    digest = hashlib.sha256()
+    for path, full_path in source_files(dir, ignore_rules(dir)):
+        digest.update(f"{path}\0{os.stat(full_path).st_mode & 0o111}\0".encode())
+        with open(full_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+def source_files(dir, rules):
+    # (relative path, full path) of the files under dir not ignored by rules, in a stable order
+    for root, dirs, files in os.walk(dir):
+        relative_root = os.path.relpath(root, dir).replace(os.sep, "/")
+        relative_root = "" if relative_root == "." else f"{relative_root}/"
+        dirs[:] = sorted(d for d in dirs if not is_ignored(f"{relative_root}{d}", rules))
+
+        for name in sorted(files):
+            path = f"{relative_root}{name}"
+            if not is_ignored(path, rules):
+                yield path, os.path.join(root, name)
+
+
+def upload_ignore_rules(dir):
+    # What gcloud leaves out of an uploaded build source, .gcloudignore with gitignore rules
+    return [(matches_pattern, ALWAYS_IGNORED + read_patterns(os.path.join(dir, ".gcloudignore")))]
+
+
+def ignore_rules(dir):
+    # [(matcher, patterns)], a path is left out of a build if either the upload (.gcloudignore, gitignore
+    # rules) or the Docker build context (.dockerignore, anchored at the context root) leaves it out
+    return upload_ignore_rules(dir) + [
+        (matches_docker_pattern, read_patterns(os.path.join(dir, ".dockerignore"))),
+    ]
+
+
+def read_patterns(path):
+    patterns = []
+    if not os.path.exists(path):
+        return patterns
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                patterns.append(line)
+    return patterns
+
+
+def is_ignored(path, rules):
+    return any(ignored_by(path, matcher, patterns) for matcher, patterns in rules)
+
+
+def ignored_by(path, matcher, patterns):
+    # Last matching pattern wins, '!' re-includes
+    ignored = False
+    for pattern in patterns:
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:]
+        if matcher(path, pattern):
+            ignored = not negate
+    return ignored
+
+
+def matches_pattern(path, pattern):
+    pattern = pattern.rstrip("/")
+    parts = path.split("/")
+    if pattern.startswith("/") or "/" in pattern:
+        pattern = pattern.lstrip("/")
+        # A path also matches if one of its parent directories does
+        return any(fnmatch.fnmatchcase("/".join(parts[:i]), pattern) for i in range(1, len(parts) + 1))
+    return any(fnmatch.fnmatchcase(part, pattern) for part in parts)
+
+
+def matches_docker_pattern(path, pattern):
+    # Docker matches the whole path from the context root, '*' doesn't cross directories and '**' does.
+    # A path also matches if one of its parent directories does
+    regex = docker_regex(pattern)
+    parts = path.split("/")
+    return any(regex.fullmatch("/".join(parts[:i])) for i in range(1, len(parts) + 1))
+
+
+@functools.lru_cache(maxsize=None)
+def docker_regex(pattern):
+    pattern = posixpath.normpath(pattern.lstrip("/"))
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 2
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 1
+        elif char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            content = pattern[i + 1:end].replace("\\", "\\\\")
+            regex += f"[{'^' + content[1:] if content.startswith(('!', '^')) else content}]"
+            i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 1
+        else:
+            regex += re.escape(char)
+        i += 1
+    return re.compile(regex)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import time
+import random
+import threading
+
+from contextlib import contextmanager
+
+RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 32.0
+
+# Requests per second per Google API to start with, halved whenever an API answers with a rate limit
+# error and raised again step by step while requests succeed, up to the starting rate
+API_RATES = {
+    "run": 10.0,
+    "iam": 5.0,
+    "cloudresourcemanager": 5.0,
+    "cloudscheduler": 5.0,
+    "cloudbuild": 5.0,
+    "containerregistry": 10.0,
+    "storage": 20.0,
+}
+MIN_API_RATE = 0.2
+
+_limits = {"processes": None, "rate": None}
+_apis = {}
+_apis_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = float(rate)
+            self.capacity = max(1.0, self.rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+
+def configure(max_processes=None, max_rate=None):
+    _limits["processes"] = threading.BoundedSemaphore(max_processes) if max_processes else None
+    _limits["rate"] = TokenBucket(max_rate) if max_rate else None
+
+
+def api_bucket(api):
+    if api not in API_RATES:
+        return None
+    with _apis_lock:
+        if api not in _apis:
+            _apis[api] = TokenBucket(API_RATES[api])
+        return _apis[api]
+
+
+def rate_limited(api):
+    bucket = api_bucket(api)
+    if bucket:
+        bucket.set_rate(max(MIN_API_RATE, bucket.rate / 2))
+
+
+def succeeded(api):
+    bucket = api_bucket(api)
+    if bucket and bucket.rate < API_RATES[api]:
+        bucket.set_rate(min(API_RATES[api], bucket.rate + API_RATES[api] / 20))
+
+
+def backoff(attempt):
+    # Jittered exponential backoff, so retries of concurrent callers don't line up
+    return random.uniform(0.5, 1.5) * min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+
+
+@contextmanager
+def slot(api=None):
+    # Held for the duration of one gcloud process or API request
+    processes, rate = _limits["processes"], _limits["rate"]
+    bucket = api_bucket(api)
+    if bucket:
+        bucket.acquire()
+    if rate:
+        rate.acquire()
+    if processes:
+        processes.acquire()
+    try:
+        yield
+    finally:
+        if processes:
+            processes.release()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import base64
+import logging
+import functools
+import threading
+import subprocess
+import configparser
+
+log = logging.getLogger(__name__)
+
+IDENTITY = "identity"
+ACCESS = "access"
+COMMANDS = {
+    IDENTITY: "gcloud auth print-identity-token",
+    ACCESS: "gcloud auth print-access-token",
+}
+
+# Identity tokens carry their own exp claim, access tokens are opaque and their expiry is looked up.
+# gcloud may print a cached token with only minutes left, so a token of unknown expiry is kept briefly
+TOKENINFO_URL = "https://oauth2.googleapis.com/tokeninfo"
+UNKNOWN_EXPIRY_LIFETIME = 5 * 60
+EXPIRY_MARGIN = 60
+REFRESH_WINDOW = 10 * 60
+
+CACHE_DIR = os.environ.get("MARATHON_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "marathon")
+CACHE_FILE = os.path.join(CACHE_DIR, "tokens.json")
+
+_lock = threading.Lock()
+_tokens = {}
+
+
+def get(kind):
+    # Cached in memory and in a user-private file shared by all marathon processes, a token close
+    # to its expiry is still used while a fresh one is fetched in the background
+    key = f"{kind}:{account()}"
+    with _lock:
+        token, expires = _tokens.get(key) or (None, 0)
+        # Another process, or the background refresh, may have written a fresher token
+        if expires - time.time() < REFRESH_WINDOW:
+            cached_token, cached_expires = read_cache(key)
+            if cached_token and cached_expires > expires:
+                token, expires = cached_token, cached_expires
+        remaining = expires - time.time()
+        if token and remaining > EXPIRY_MARGIN:
+            _tokens[key] = (token, expires)
+            if remaining < REFRESH_WINDOW:
+                refresh_in_background(kind)
+            return token
+
+        token, expires = fetch(kind)
+        if token:
+            _tokens[key] = (token, expires)
+            write_cache(key, token, expires)
+        return token
+
+
+def invalidate(kind, token):
+    # Drops a token the API rejected, unless it has already been replaced
+    key = f"{kind}:{account()}"
+    with _lock:
+        if (_tokens.get(key) or (None, 0))[0] == token:
+            del _tokens[key]
+        if read_cache(key)[0] == token:
+            write_cache(key, None, 0)
+
+
+def fetch(kind):
+    from marathon import gcloud
+
+    try:
+        token, _ = gcloud.eval_noout(COMMANDS[kind])
+    except Exception as e:
+        log.debug(e)
+        return None, 0
+    if not token or not token.strip():
+        return None, 0
+    token = token.strip()
+    expires = token_expiry(token) or (access_token_expiry(token) if kind == ACCESS else None)
+    return token, expires or time.time() + UNKNOWN_EXPIRY_LIFETIME
+
+
+def token_expiry(token):
+    # The exp claim of a JWT, None for opaque tokens
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return None
+
+
+def access_token_expiry(token):
+    # From the expires_in of Google's tokeninfo endpoint, None if it can't be reached
+    import http.client
+    from urllib.parse import urlsplit, quote
+
+    tokeninfo = urlsplit(TOKENINFO_URL)
+    endpoint = urlsplit(os.environ.get("MARATHON_API_ENDPOINT") or TOKENINFO_URL)
+    connection_class = http.client.HTTPConnection if endpoint.scheme == "http" else http.client.HTTPSConnection
+    conn = connection_class(endpoint.netloc, timeout=10)
+    try:
+        conn.request("GET", f"{tokeninfo.path}?access_token={quote(token, safe='')}",
+                     headers={"Host": tokeninfo.netloc})
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            log.debug(f"Could not look up the access token expiry: {response.status}")
+            return None
+        return time.time() + float(json.loads(data)["expires_in"])
+    except (OSError, http.client.HTTPException, ValueError, KeyError, TypeError) as e:
+        log.debug(f"Could not look up the access token expiry: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+@functools.lru_cache(maxsize=None)
+def account():
+    # Read from the gcloud config files once per process, so a cached token is never used for another account
+    if os.environ.get("CLOUDSDK_CORE_ACCOUNT"):
+        return os.environ["CLOUDSDK_CORE_ACCOUNT"]
+
+    config_dir = os.environ.get("CLOUDSDK_CONFIG") or os.path.expanduser("~/.config/gcloud")
+    name = os.environ.get("CLOUDSDK_ACTIVE_CONFIG_NAME")
+    if not name:
+        try:
+            with open(os.path.join(config_dir, "active_config"), "r") as f:
+                name = f.read().strip()
+        except OSError:
+            name = "default"
+
+    config = configparser.ConfigParser()
+    try:
+        config.read(os.path.join(config_dir, "configurations", f"config_{name}"))
+        return config.get("core", "account", fallback=name)
+    except configparser.Error:
+        return name
+
+
+def read_cache(key):
+    try:
+        with open(CACHE_FILE, "r") as f:
+            entry = json.load(f).get(key) or {}
+        return entry.get("token"), float(entry.get("expires", 0))
+    except (OSError, ValueError, AttributeError):
+        return None, 0
+
+
+def write_cache(key, token, expires):
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        os.chmod(CACHE_DIR, 0o700)
+        try:
+            with open(CACHE_FILE, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        now = time.time()
+        cache = {k: v for k, v in cache.items() if isinstance(v, dict) and v.get("expires", 0) > now}
+        cache.pop(key, None)
+        if token:
+            cache[key] = {"token": token, "expires": expires}
+
+        # Created with 0600 and swapped in atomically, a concurrent reader never sees a partial file
+        tmp_file = f"{CACHE_FILE}.{os.getpid()}.tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, CACHE_FILE)
+    except OSError as e:
+        log.debug(f"Could not write token cache: {e}")
+
+
+def refresh_in_background(kind):
+    # A detached process, so a short-lived command like 'run invoke' doesn't wait for gcloud on exit
+    marker = os.path.join(CACHE_DIR, f"refresh-{kind}")
+    try:
+        if time.time() - os.path.getmtime(marker) < EXPIRY_MARGIN:
+            return
+    except OSError:
+        pass
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        with open(marker, "w"):
+            pass
+        subprocess.Popen([sys.executable, "-m", "marathon.tokens", kind], start_new_session=True,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        log.debug(f"Could not refresh {kind} token in the background: {e}")
+
+
+def refresh(kind):
+    token, expires = fetch(kind)
+    if token:
+        write_cache(f"{kind}:{account()}", token, expires)
+
+
+if __name__ == "__main__":
+    refresh(sys.argv[1])
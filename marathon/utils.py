@@ -1,24 +1,45 @@
 #!/usr/bin/env python3
 
-import re
 import logging
-import yaml
 
 import marathon.cached as cached
+from marathon.config import MarathonConfig
 
 log = logging.getLogger(__name__)
 
-VAR_REGEX = re.compile("\${(.*?)}")
+
+def get_marathon_source():
+    # run.yaml as loaded by yaml, shared by the base config and the config of every environment
+    if cached.marathon_source is None:
+        import yaml
+        with open("run.yaml", "r") as f:
+            cached.marathon_source = yaml.safe_load(f)
+
+    return cached.marathon_source
 
 
 def get_marathon_config():
-    if not cached.marathon_config:
-        with open("run.yaml", "r") as f:
-            cached.marathon_config = yaml.safe_load(f)
+    # Parsed and interpolated once, raises ConfigError for invalid variables or service links
+    if cached.marathon_config is None:
+        cached.marathon_config = MarathonConfig(get_marathon_source())
 
     return cached.marathon_config
 
 
+def get_environment_config(environment):
+    # The overrides of one environment in run.yaml merged over the shared base
+    if environment not in cached.environment_configs:
+        cached.environment_configs[environment] = MarathonConfig(get_marathon_source(), environment)
+
+    return cached.environment_configs[environment]
+
+
+def environment_names():
+    source = get_marathon_source()
+    environments = source.get("environments") if isinstance(source, dict) else None
+    return [str(name) for name in environments or {}]
+
+
 def init_marathon_config():
     return {
         "project": "your_project",
@@ -56,36 +77,25 @@ def init_marathon_config():
     }
 
 
-def interpolate_var(string):
-    interpolated_string = str(string)
-    for match in set(re.findall(VAR_REGEX, str(string))):
-        try:
-            match_interpolation = get_marathon_config()[match]
-            interpolated_string = string.replace("${{{}}}".format(match), match_interpolation)
-        except KeyError:
-            log.error(f"Failed to interpolate {string} in run.yaml")
-
-    return interpolated_string
-
-
 def service_iter():
-    for service in get_marathon_config().keys():
-        if service != "project" and service != "region" and service != "allow-invoke":
-            yield service
+    yield from get_marathon_config().services
 
 
-def service_dependencies():
-    deps_map = {}
-    nodeps_list = []
+def default_region(service):
+    # The first region of the service in run.yaml, or the first-level one
     conf = get_marathon_config()
-    for service in service_iter():
-        if "links" in conf[service] and len(conf[service]["links"]) > 0:
-            deps_map[service] = set(conf[service]["links"])
-        else:
-            nodeps_list.append(service)
-
-    return deps_map, nodeps_list
+    if service in conf.services:
+        return conf.services[service].region
+    return conf.region
 
 
 def sanitize_service_name(service):
     return service.lower().replace("_", "-")
+
+
+def pin_image(image, digest):
+    # gcr.io/project/service:latest -> gcr.io/project/service@sha256:...
+    repository = image.split("@", 1)[0]
+    if ":" in repository.rsplit("/", 1)[-1]:
+        repository = repository.rsplit(":", 1)[0]
+    return f"{repository}@{digest}"
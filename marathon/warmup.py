@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import logging
+
+from marathon.config import ConfigError
+
+log = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "paths": ["/"],
+    "method": "GET",
+    "requests": 10,
+    "concurrency": 5,
+}
+
+
+def settings(service):
+    # The service's 'warmup' block on top of the defaults, 'warmup: true' uses the defaults
+    warmup = service.warmup
+    if warmup is None or warmup is False:
+        return None
+    if warmup is True:
+        warmup = {}
+    if not isinstance(warmup, dict):
+        raise ConfigError(f"'{service.name}.warmup' in run.yaml must be a mapping or true")
+    unknown = sorted(set(warmup) - set(DEFAULTS))
+    if unknown:
+        raise ConfigError(f"Unknown keys in '{service.name}.warmup' in run.yaml: {', '.join(unknown)}")
+
+    conf = {**DEFAULTS, **warmup}
+    try:
+        conf["paths"] = [str(path) for path in conf["paths"]]
+        conf["requests"] = int(conf["requests"])
+        conf["concurrency"] = int(conf["concurrency"])
+    except (TypeError, ValueError) as e:
+        raise ConfigError(f"Invalid '{service.name}.warmup' in run.yaml: {e}")
+    conf["method"] = str(conf["method"]).upper()
+    return conf
+
+
+def run(service, url, token):
+    # Concurrent requests start enough instances to serve them, so the first users don't hit a cold start
+    from marathon import load
+
+    conf = settings(service)
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    for path in conf["paths"]:
+        stats = load.run(url, conf["method"], path, "", headers, conf["requests"], conf["concurrency"])
+        result = load.summary(stats)
+        if result["errors"]:
+            log.warning(f"[{service.target}]: {result['errors']} of {result['requests']} warm-up requests"
+                        f" to {path} failed")
+        else:
+            log.info(f"[{service.target}]: Warmed up {path} with {result['requests']} requests,"
+                     f" p50 {result['p50'] * 1000:.1f}ms, max {result['max'] * 1000:.1f}ms")
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+from marathon import state
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII")
+
+
+def watcher(dirs, polling=False, poll_interval=1.0):
+    if not polling:
+        try:
+            return InotifyWatcher(dirs)
+        except OSError as e:
+            log.debug(f"inotify is not available, polling for changes instead: {e}")
+    return PollingWatcher(dirs, poll_interval)
+
+
+class InotifyWatcher:
+    # Linux inotify through ctypes, one watch per directory since inotify isn't recursive
+    def __init__(self, dirs):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify_init1 not found in libc")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {}
+        self.rules = {}
+        for dir in dirs:
+            self.rules[dir] = state.ignore_rules(dir)
+            self.add_tree(dir, dir)
+
+    def add_tree(self, root, dir):
+        for path, subdirs, _ in os.walk(dir):
+            relative = os.path.relpath(path, root).replace(os.sep, "/")
+            if relative != "." and state.is_ignored(relative, self.rules[root]):
+                subdirs[:] = []
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                # The directory may already be gone again, or the watch limit was reached
+                log.debug(f"Could not watch {path}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.watches[wd] = (root, path)
+
+    def changes(self, timeout):
+        # Returns the set of watched dirs with a relevant change, waiting at most timeout seconds
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = EVENT.unpack_from(buffer, offset)
+                name = buffer[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self.rules)
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if wd not in self.watches:
+                    continue
+
+                root, dir = self.watches[wd]
+                path = os.path.join(dir, os.fsdecode(name))
+                relative = os.path.relpath(path, root).replace(os.sep, "/")
+                if state.is_ignored(relative, self.rules[root]):
+                    continue
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(root, path)
+                changed.add(root)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # Compares modification times and sizes of every file that isn't ignored
+    def __init__(self, dirs, interval):
+        self.interval = interval
+        self.snapshots = {dir: snapshot(dir) for dir in dirs}
+        self.scanned = time.monotonic()
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        if time.monotonic() - self.scanned < self.interval:
+            return set()
+
+        self.scanned = time.monotonic()
+        changed = set()
+        for dir, previous in self.snapshots.items():
+            current = snapshot(dir)
+            if current != previous:
+                self.snapshots[dir] = current
+                changed.add(dir)
+        return changed
+
+    def close(self):
+        pass
+
+
+def snapshot(dir):
+    rules = state.ignore_rules(dir)
+    files = {}
+    for root, dirs, names in os.walk(dir):
+        relative_root = os.path.relpath(root, dir).replace(os.sep, "/")
+        relative_root = "" if relative_root == "." else f"{relative_root}/"
+        dirs[:] = [d for d in dirs if not state.is_ignored(f"{relative_root}{d}", rules)]
+        for name in names:
+            path = f"{relative_root}{name}"
+            if state.is_ignored(path, rules):
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Fake Google APIs and registries for the api backend, dispatching on the Host header like the real endpoints.
+# Point marathon at it with MARATHON_API_ENDPOINT=http://127.0.0.1:<port>, the stub gcloud in this
+# directory still provides the access token.
+#
+#   scripts/benchmark/api_server.py --port 8080 --latency 0.05 --log requests.log
+#
+# With --port 0 a free port is picked, the port is printed on the first line of stdout.
+
+import re
+import json
+import time
+import hashlib
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+_lock = threading.Lock()
+services = {}
+service_accounts = set()
+policies = {}
+jobs = {}
+builds = {}
+buckets = set()
+digests = {}
+
+
+def run_services(method, path, body):
+    # {region}-run.googleapis.com/apis/serving.knative.dev/v1/namespaces/{project}/services[/{name}]
+    match = re.fullmatch(r"/apis/serving\.knative\.dev/v1/namespaces/([^/]+)/services(?:/([^/]+))?", path)
+    if not match:
+        return 404, None
+    project, name = match.groups()
+    if not name:
+        if method == "GET":
+            return 200, {"items": [item for (p, _), item in services.items() if p == project]}
+        name = body["metadata"]["name"]
+        if (project, name) in services:
+            return 409, None
+    elif method == "GET":
+        return (200, services[(project, name)]) if (project, name) in services else (404, None)
+
+    body["status"] = {"url": f"https://{name}-abcdefghij-ew.a.run.app",
+                      "conditions": [{"type": "Ready", "status": "True"}]}
+    services[(project, name)] = body
+    return 200, body
+
+
+def iam_policy(method, path, body):
+    # :getIamPolicy and :setIamPolicy of projects and Cloud Run services
+    resource, _, verb = path.rpartition(":")
+    if verb == "getIamPolicy":
+        return 200, policies.get(resource, {"etag": "BwWKmjvelug=", "version": 1, "bindings": []})
+    if verb == "setIamPolicy":
+        policies[resource] = body["policy"]
+        return 200, body["policy"]
+    return 404, None
+
+
+def iam(method, path, body):
+    match = re.fullmatch(r"/v1/projects/([^/]+)/serviceAccounts(?:/([^/]+))?", path)
+    if not match:
+        return 404, None
+    project, email = match.groups()
+    if email:
+        return (200, {"email": email}) if email in service_accounts else (404, None)
+    if method == "GET":
+        return 200, {"accounts": [{"email": email} for email in sorted(service_accounts)
+                                  if email.endswith(f"@{project}.iam.gserviceaccount.com")]}
+    email = f"{body['accountId']}@{project}.iam.gserviceaccount.com"
+    if email in service_accounts:
+        return 409, None
+    service_accounts.add(email)
+    return 200, {"email": email}
+
+
+def scheduler(method, path, body):
+    if method == "POST":
+        jobs[body["name"]] = body
+        return 200, body
+    name = path[len("/v1/"):]
+    if name.endswith("/jobs"):
+        return 200, {"jobs": [job for job_name, job in sorted(jobs.items()) if job_name.startswith(f"{name}/")]}
+    if method == "PATCH":
+        jobs[name] = body
+        return 200, body
+    return (200, jobs[name]) if name in jobs else (404, None)
+
+
+def cloudbuild(method, path, body):
+    if method == "POST":
+        build_id = str(len(builds) + 1)
+        builds[build_id] = body
+        return 200, {"metadata": {"build": {"id": build_id}}}
+    build_id = path.rsplit("/", 1)[-1]
+    if build_id not in builds:
+        return 404, None
+    images = [{"name": image, "digest": "sha256:" + hashlib.sha256(f"{image}{build_id}".encode()).hexdigest()}
+              for image in builds[build_id].get("images", [])]
+    digests.update((image["name"], image["digest"]) for image in images)
+    return 200, {"id": build_id, "status": "SUCCESS", "results": {"images": images}}
+
+
+def registry(host, method, path):
+    # /v2/{repository}/manifests/{tag}, every tag exists, pointing at the image of its latest build
+    match = re.fullmatch(r"/v2/(.+)/manifests/([^/]+)", path)
+    if not match:
+        return 404, None
+    image = f"{host}/{match.group(1)}:{match.group(2)}"
+    digest = digests.get(image) or "sha256:" + hashlib.sha256(image.encode()).hexdigest()
+    return 200, {"schemaVersion": 2}, {"Docker-Content-Digest": digest}
+
+
+def storage(method, path, body):
+    match = re.fullmatch(r"/storage/v1/b/([^/]+)", path)
+    if match:
+        return (200, {"name": match.group(1)}) if match.group(1) in buckets else (404, None)
+    if path == "/storage/v1/b":
+        buckets.add(body["name"])
+        return 200, body
+    if path.startswith("/upload/storage/v1/b/"):
+        return 200, {}
+    return 404, None
+
+
+def tokeninfo(method, path, body):
+    return 200, {"expires_in": "3599"}
+
+
+def handler(host, path):
+    if host.endswith("-run.googleapis.com"):
+        return run_services
+    if host.endswith("gcr.io") or host.endswith("-docker.pkg.dev"):
+        return lambda method, path, body: registry(host, method, path)
+    if ":" in path and host in ("run.googleapis.com", "cloudresourcemanager.googleapis.com"):
+        return iam_policy
+    return {
+        "iam.googleapis.com": iam,
+        "cloudscheduler.googleapis.com": scheduler,
+        "cloudbuild.googleapis.com": cloudbuild,
+        "storage.googleapis.com": storage,
+        "oauth2.googleapis.com": tokeninfo,
+    }.get(host)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else b""
+        host = self.headers.get("Host", "")
+        if self.server.log_file:
+            with _lock, open(self.server.log_file, "a") as f:
+                f.write(f"{self.command} {host}{url.path} {length}\n")
+        time.sleep(self.server.latency)
+
+        fn = handler(host, url.path)
+        try:
+            body = json.loads(data) if data and "json" in self.headers.get("Content-Type", "") else None
+        except ValueError:
+            body = None
+        with _lock:
+            status, response, *headers = fn(self.command, url.path, body) if fn else (404, None)
+        if response is None:
+            response = {"error": {"code": status, "message": f"{self.command} {host}{self.path}"}}
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers[0] if headers else {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Google APIs for marathon's api backend")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on, 0 picks a free one")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request, default is 0.05")
+    parser.add_argument("--log", type=str, metavar="FILE", help="Append every request to this file")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.latency = args.latency
+    server.log_file = args.log
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# Offline benchmark of marathon's orchestration overhead, using the stub gcloud in this directory.
+#
+#   scripts/benchmark/benchmark.py --services 10,50 --commands deploy,build
+#   scripts/benchmark/benchmark.py --json new.json --baseline old.json --max-regression 0.2
+#
+# Any arguments after '--' are passed to marathon, e.g. '-- --no-prefetch --jobs 8'.
+# With '--backend api' marathon talks to the fake Google APIs in api_server.py instead, started for each run.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import yaml
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark marathon against a stub gcloud")
+    parser.add_argument("--services", type=str, default="10,50",
+                        help="Comma separated numbers of services to generate, default is 10,50")
+    parser.add_argument("--commands", type=str, default="deploy,build",
+                        help="Comma separated marathon commands to run, default is deploy,build")
+    parser.add_argument("--links", type=float, default=0.1,
+                        help="Probability of a link between two services, default is 0.1")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds per stub gcloud call, default is 0.05")
+    parser.add_argument("--deploy-latency", type=float, default=0.5,
+                        help="Seconds per stub 'gcloud run deploy', default is 0.5")
+    parser.add_argument("--build-latency", type=float, default=1.0,
+                        help="Seconds per stub 'gcloud builds submit', default is 1.0")
+    parser.add_argument("--backend", type=str, choices=["gcloud", "api"], default="gcloud",
+                        help="Marathon backend, api runs against api_server.py, default is gcloud")
+    parser.add_argument("--existing", action="store_true", default=False,
+                        help="Pretend service accounts and scheduler jobs already exist")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case, the best one is kept")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the generated run.yaml")
+    parser.add_argument("--json", type=str, metavar="FILE", help="Write the results as JSON")
+    parser.add_argument("--baseline", type=str, metavar="FILE", help="Compare against earlier --json results")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Fail if wall-clock time regresses by more than this ratio, default is 0.2")
+    parser.add_argument("marathon_args", nargs=argparse.REMAINDER,
+                        help="Extra arguments for marathon, after '--'")
+    args = parser.parse_args()
+    marathon_args = [arg for arg in args.marathon_args if arg != "--"]
+
+    results = {}
+    for count in [int(n) for n in args.services.split(",")]:
+        workdir = tempfile.mkdtemp(prefix="marathon-bench-")
+        try:
+            generate_project(workdir, count, args.links, random.Random(args.seed))
+            for command in args.commands.split(","):
+                runs = [run_case(workdir, command, marathon_args, args) for _ in range(args.repeat)]
+                results[f"{command}/{count}"] = min(runs, key=lambda r: r["wall_clock"])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline and not compare(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+def generate_project(workdir, count, link_probability, rng):
+    run_yaml = {
+        "project": "benchmark-project",
+        "region": "europe-west1",
+        "allow-invoke": ["user:benchmark@example.com", "group:team@example.com"],
+    }
+    for i in range(count):
+        service = f"service{i}"
+        conf = {"image": f"gcr.io/${{project}}/{service}:latest", "dir": f"apps/{service}",
+                "env": {"INDEX": str(i)}}
+        # Only link to lower numbered services so the graph stays acyclic
+        links = [f"service{j}" for j in range(i) if rng.random() < link_probability]
+        if links:
+            conf["links"] = links
+        if rng.random() < 0.2:
+            conf["iam-roles"] = ["roles/pubsub.publisher"]
+        if rng.random() < 0.1:
+            conf["cron"] = {"schedule": "0 * * * *"}
+        run_yaml[service] = conf
+
+        os.makedirs(os.path.join(workdir, "apps", service))
+        with open(os.path.join(workdir, "apps", service, "Dockerfile"), "w") as f:
+            f.write(f"FROM python:3-slim\nENV SERVICE={service}\n")
+
+    with open(os.path.join(workdir, "run.yaml"), "w") as f:
+        yaml.dump(run_yaml, stream=f)
+
+
+def run_case(workdir, command, marathon_args, args):
+    log_file = os.path.join(workdir, "gcloud.log")
+    if os.path.exists(log_file):
+        os.remove(log_file)
+    shutil.rmtree(os.path.join(workdir, ".marathon"), ignore_errors=True)
+
+    env = dict(os.environ)
+    env.update({
+        "PATH": f"{BENCHMARK_DIR}{os.pathsep}{env.get('PATH', '')}",
+        "PYTHONPATH": REPO_DIR,
+        "FAKE_GCLOUD_LOG": log_file,
+        "FAKE_GCLOUD_LATENCY": str(args.latency),
+        "FAKE_GCLOUD_LATENCY_DEPLOY": str(args.deploy_latency),
+        "FAKE_GCLOUD_LATENCY_SUBMIT": str(args.build_latency),
+    })
+    if args.existing:
+        env["FAKE_GCLOUD_EXISTING"] = "1"
+
+    server = None
+    if args.backend == "api":
+        # The server logs its requests next to the stub's gcloud calls, both count as calls
+        server = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "api_server.py"), "--port", "0",
+                                   "--latency", str(args.latency), "--log", log_file],
+                                  stdout=subprocess.PIPE)
+        port = server.stdout.readline().decode().strip()
+        env["MARATHON_API_ENDPOINT"] = f"http://127.0.0.1:{port}"
+        env["MARATHON_CACHE_DIR"] = os.path.join(workdir, ".marathon", "cache")
+        marathon_args = ["--backend", "api"] + marathon_args
+
+    try:
+        start = time.monotonic()
+        proc = subprocess.Popen([sys.executable, "-m", "marathon", command, "--quiet"] + marathon_args,
+                                cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall_clock = time.monotonic() - start
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if proc.returncode != 0:
+        print(f"{command} failed:\n{proc.stderr.read().decode()}", file=sys.stderr)
+        sys.exit(1)
+
+    with open(log_file, "r") as f:
+        calls = [line.split() for line in f]
+    return {
+        "wall_clock": wall_clock,
+        "gcloud_calls": len(calls),
+        # ru_maxrss is in KB on Linux
+        "peak_memory_mb": rusage.ru_maxrss / 1024,
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+    }
+
+
+def print_results(results):
+    print(f"{'case':<16} {'wall clock':>11} {'gcloud calls':>13} {'peak memory':>12} {'cpu':>8}")
+    for case, result in results.items():
+        print(f"{case:<16} {result['wall_clock']:10.2f}s {result['gcloud_calls']:>13}"
+              f" {result['peak_memory_mb']:10.1f}MB {result['cpu_seconds']:7.2f}s")
+
+
+def compare(results, baseline_file, max_regression):
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+
+    ok = True
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        before, after = baseline[case]["wall_clock"], result["wall_clock"]
+        change = (after - before) / before if before else 0.0
+        calls = result["gcloud_calls"] - baseline[case]["gcloud_calls"]
+        print(f"{case:<16} {before:8.2f}s -> {after:8.2f}s ({change:+.0%}), gcloud calls {calls:+d}")
+        if change > max_regression:
+            print(f"{case}: wall-clock regression above {max_regression:.0%}", file=sys.stderr)
+            ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    main()
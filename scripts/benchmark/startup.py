@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Startup regression check: asserts that light commands don't import the modules only needed for
+# deploys, builds or invocations, and that their total import time stays within a budget.
+#
+#   scripts/benchmark/startup.py
+#   scripts/benchmark/startup.py --budget-ms 80 --repeat 10
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+
+HEAVY_MODULES = ["yaml", "toposort", "http.client", "concurrent.futures", "marathon.gcloud",
+                 "marathon.api", "marathon.commands"]
+
+# (marathon arguments, modules that must not be imported)
+CASES = [
+    (["--version"], HEAVY_MODULES),
+    (["deploy", "--help"], HEAVY_MODULES),
+    (["ls"], ["toposort", "http.client", "concurrent.futures", "marathon.api", "marathon.commands"]),
+    (["describe", "service1"], ["toposort", "http.client", "concurrent.futures", "marathon.api"]),
+]
+
+RUN_YAML = """project: startup-project
+region: europe-west1
+service1:
+  image: gcr.io/${project}/service1:latest
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check marathon's startup imports and import time")
+    parser.add_argument("--budget-ms", type=float, default=100.0,
+                        help="Maximum total import time per command in milliseconds, default is 100")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command, the best one is kept")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="marathon-startup-")
+    ok = True
+    try:
+        with open(os.path.join(workdir, "run.yaml"), "w") as f:
+            f.write(RUN_YAML)
+
+        print(f"{'command':<20} {'import time':>12} {'modules':>8}")
+        for marathon_args, forbidden in CASES:
+            runs = [import_times(workdir, marathon_args) for _ in range(args.repeat)]
+            times = min(runs, key=lambda t: sum(t.values()))
+            total_ms = sum(times.values()) / 1000
+            command = " ".join(marathon_args)
+            print(f"{command:<20} {total_ms:10.1f}ms {len(times):>8}")
+
+            imported = [module for module in forbidden if module in times]
+            if imported:
+                print(f"{command}: imports {', '.join(imported)}", file=sys.stderr)
+                ok = False
+            if total_ms > args.budget_ms:
+                print(f"{command}: import time above the {args.budget_ms:.0f}ms budget", file=sys.stderr)
+                ok = False
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if not ok:
+        sys.exit(1)
+
+
+def import_times(workdir, marathon_args):
+    env = dict(os.environ)
+    env.update({
+        "PATH": f"{BENCHMARK_DIR}{os.pathsep}{env.get('PATH', '')}",
+        "PYTHONPATH": REPO_DIR,
+        "FAKE_GCLOUD_LOG": os.devnull,
+        "FAKE_GCLOUD_LATENCY": "0",
+    })
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-m", "marathon"] + marathon_args,
+                          cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # Lines look like 'import time:  self [us] | cumulative | imported package'
+    times = {}
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, module = line[len("import time:"):].split("|")
+        times[module.strip()] = int(self_us)
+    return times
+
+
+if __name__ == "__main__":
+    main()